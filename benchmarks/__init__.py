@@ -0,0 +1,20 @@
+'''
+benchmarks of the medipay database queries and endpoints,
+run them against a separate database seeded with benchmarks.seed
+'''
+import os
+
+from project import create_app
+
+
+def create_benchmark_app(database_url):
+    '''
+    creates the app which uses the given benchmark database
+    '''
+    app = create_app(os.getenv('FLASK_CONFIG') or 'testing')
+
+    # the engine is created on the first use,
+    # so the url may still be changed here
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+
+    return app
@@ -0,0 +1,394 @@
+'''
+times the hot endpoints and the chat Socket.IO events and writes
+the results to JSON, which can be compared with the results of
+another commit
+
+    python -m benchmarks.endpoints --rows 100000 \\
+        --database sqlite:////tmp/medipay_benchmark.db \\
+        --output after.json --baseline before.json
+
+the database is seeded only if it is empty, Redis should be running
+'''
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+from datetime import datetime
+
+from flask import session
+from flask_login import login_user
+from sqlalchemy import and_, event, func
+
+from project import db, models, socketio
+
+from . import create_benchmark_app
+from .seed import BENCHMARK_PASSWORD, BENCHMARK_USERS, seed
+
+
+# a benchmark is reported as a regression,
+# if its median time is that much slower than the baseline's
+REGRESSION_THRESHOLD = 0.2
+
+
+class QueryCounter(object):
+    '''
+    counts the statements executed by the app's engine
+    '''
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+
+    return values[index]
+
+
+def is_error(status):
+    return not 200 <= status < 400
+
+
+def summarize(name, timings, queries, statuses):
+    return {
+        'name': name,
+        'runs': len(timings),
+        'min_ms': round(min(timings), 3),
+        'median_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'max_ms': round(max(timings), 3),
+        'queries': max(queries),
+        'statuses': sorted(set(statuses)),
+        # the timings of the failed requests aren't comparable
+        'errors': len([status for status in statuses if is_error(status)])
+    }
+
+
+def user_email(user_type):
+    for user in BENCHMARK_USERS:
+        if user['user_type'] == user_type:
+            return user['email']
+
+
+def user_api_key(user_type):
+    for user in BENCHMARK_USERS:
+        if user['user_type'] == user_type:
+            return user['api_key']
+
+
+def login(client, user_type):
+    response = client.post('/auth/login', data={
+        'email': user_email(user_type),
+        'password': BENCHMARK_PASSWORD,
+        'user_type': user_type
+    })
+
+    if response.status_code != 302:
+        raise RuntimeError('Could not log in as the benchmark %s' % user_type)
+
+
+def added_claims_cleanup(member, terminal):
+    '''
+    returns the function, which deletes the claims added by the
+    add-by-terminal requests and the member's new link to the provider,
+    so every run and every benchmark starts with the seeded data
+    '''
+    last_id = db.session.query(func.max(models.Claim.id)).scalar() or 0
+    linked = terminal.provider in member.providers
+    member_id, provider_id = member.id, terminal.provider_id
+
+    def cleanup():
+        models.Claim.query.filter(models.Claim.id > last_id)\
+            .delete(synchronize_session=False)
+
+        if not linked:
+            table = models.custom_members
+            db.session.execute(table.delete().where(and_(
+                table.c.member_id == member_id,
+                table.c.provider_id == provider_id)))
+
+        db.session.commit()
+
+    return cleanup
+
+
+def http_benchmarks():
+    '''
+    returns the (user type, name, method, url, JSON body, cleanup) of
+    the timed requests, the None user type is the API, which uses the
+    API key, the cleanup runs after every request, which changes data
+    '''
+    member = models.Member.query.first()
+    terminal = models.Terminal.query.first()
+    api_key = user_api_key('provider')
+
+    benchmarks = []
+
+    for user_type in ['provider', 'payer']:
+        benchmarks.extend([
+            (user_type, 'index', 'GET', '/', None, None),
+            (user_type, 'history', 'GET', '/history', None, None),
+            (user_type, 'search', 'GET', '/search?query=Member+1', None,
+             None),
+            (user_type, 'get_gops', 'GET', '/get-gops?page=1', None, None),
+            (user_type, 'get_gops_all', 'GET', '/get-gops', None, None),
+            (user_type, 'one_tap_index', 'GET', '/1tap/', None, None)
+        ])
+
+    benchmarks.extend([
+        ('provider', 'icd_code_search', 'GET',
+         '/icd-code/search?query=fever', None, None),
+        (None, 'api_requests', 'GET',
+         '/api/requests?api_key=%s&limit=100' % api_key, None, None),
+        (None, 'api_claim_add_by_terminal', 'POST',
+         '/api/claim/add-by-terminal',
+         {'user_id': member.id, 'terminal_uid': terminal.device_uid},
+         added_claims_cleanup(member, terminal))
+    ])
+
+    return benchmarks
+
+
+def time_http(app, benchmarks, repeat, counter):
+    results = []
+    clients = {}
+
+    for user_type, name, method, url, body, cleanup in benchmarks:
+        if user_type not in clients:
+            clients[user_type] = app.test_client()
+
+            if user_type:
+                login(clients[user_type], user_type)
+
+        client = clients[user_type]
+        timings, queries, statuses = [], [], []
+
+        # the first request warms up the caches and is not counted
+        for run in range(repeat + 1):
+            counter.count = 0
+            started = time.time()
+
+            if method == 'POST':
+                response = client.post(url, data=json.dumps(body),
+                                       content_type='application/json')
+            else:
+                response = client.get(url)
+
+            elapsed = (time.time() - started) * 1000
+
+            if run:
+                timings.append(elapsed)
+                queries.append(counter.count)
+                statuses.append(response.status_code)
+
+            if cleanup:
+                with app.app_context():
+                    cleanup()
+
+        if user_type:
+            name = '%s:%s' % (user_type, name)
+
+        results.append(summarize(name, timings, queries, statuses))
+
+    return results
+
+
+def register_benchmark_login():
+    '''
+    the Socket.IO event, which logs in the provider user and sets
+    the chat session the way the GOP request page sets it
+    '''
+    @socketio.on('benchmark-login', namespace='/chat')
+    def benchmark_login(data):
+        gop = models.GuaranteeOfPayment.query.get(data['gop_id'])
+
+        login_user(models.User.query.get(data['user_id']))
+        session['room'] = 'gop%d' % gop.id
+        session['gop_id'] = gop.id
+        session['name'] = 'Benchmark'
+        session['provider_user_id'] = gop.provider.user_id
+        session['payer_user_id'] = gop.payer.user_id
+
+
+def chat_login_data():
+    '''
+    returns the data of the benchmark-login event: a GOP request
+    of the benchmark provider and the provider user's id
+    '''
+    provider_user = [u for u in BENCHMARK_USERS \
+                     if u['user_type'] == 'provider'][0]
+    gop = models.GuaranteeOfPayment.query.filter_by(provider_id=1).first()
+
+    return {'gop_id': gop.id, 'user_id': provider_user['id']}
+
+
+def time_socketio(app, login_data, repeat, counter):
+    '''
+    times the chat events with the Socket.IO test client
+    '''
+    register_benchmark_login()
+
+    client = socketio.test_client(app, namespace='/chat')
+    client.emit('benchmark-login', login_data, namespace='/chat')
+
+    events = [
+        ('joined', lambda: client.emit('joined', {}, namespace='/chat')),
+        ('text', lambda: client.emit('text', {'msg': 'Benchmark message'},
+                                     namespace='/chat'))
+    ]
+
+    results = []
+
+    for name, emit in events:
+        timings, queries = [], []
+
+        for run in range(repeat + 1):
+            counter.count = 0
+            started = time.time()
+            emit()
+            elapsed = (time.time() - started) * 1000
+            client.get_received('/chat')
+
+            if run:
+                timings.append(elapsed)
+                queries.append(counter.count)
+
+        results.append(summarize('socketio:chat:' + name, timings, queries,
+                                 []))
+
+    client.disconnect(namespace='/chat')
+
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD']).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def failures(results):
+    '''
+    returns the names of the benchmarks, which got error responses
+    '''
+    return [result['name'] for result in results['results'] \
+            if result['errors']]
+
+
+def compare(results, baseline):
+    '''
+    returns the benchmarks whose median time is slower than
+    the baseline's by more than the threshold
+    '''
+    baseline = dict((r['name'], r) for r in baseline['results'])
+    regressions = []
+
+    for result in results['results']:
+        before = baseline.get(result['name'])
+
+        if not before or not before['median_ms']:
+            continue
+
+        change = result['median_ms'] / before['median_ms'] - 1
+
+        if change > REGRESSION_THRESHOLD:
+            regressions.append({
+                'name': result['name'],
+                'baseline_median_ms': before['median_ms'],
+                'median_ms': result['median_ms'],
+                'change': round(change, 3)
+            })
+
+    return regressions
+
+
+def run(app, repeat):
+    # the run measures the requests, so the figures aren't aggregated
+    app.config['DB_INSTRUMENTATION_AGGREGATE'] = False
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        engine = db.engine
+        benchmarks = http_benchmarks()
+        login_data = chat_login_data()
+
+    # the requests run outside of the app context,
+    # so each of them gets its own context and session
+    counter = QueryCounter()
+    event.listen(engine, 'after_cursor_execute', counter)
+
+    try:
+        results = time_http(app, benchmarks, repeat, counter)
+        results.extend(time_socketio(app, login_data, repeat, counter))
+    finally:
+        event.remove(engine, 'after_cursor_execute', counter)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database',
+                        default='sqlite:////tmp/medipay_benchmark.db',
+                        help='the url of the benchmark database')
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='the number of the claims and GOP requests, '
+                             'from 1000 to 1000000')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='the number of runs of each benchmark')
+    parser.add_argument('--output', help='the JSON file of the results')
+    parser.add_argument('--baseline',
+                        help='the JSON results to compare the run with')
+    args = parser.parse_args(argv)
+
+    app = create_benchmark_app(args.database)
+
+    with app.app_context():
+        db.create_all()
+
+        if not models.Claim.query.first():
+            seed(args.rows)
+
+        output = {
+            'revision': git_revision(),
+            'datetime': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'database': db.engine.dialect.name,
+            'rows': models.Claim.query.count()
+        }
+
+    output['results'] = run(app, args.repeat)
+    output['failures'] = failures(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            output['regressions'] = compare(output, json.load(f))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    # fails if any of the benchmarks got error responses
+    # or got slower than the baseline
+    if output['failures']:
+        sys.stderr.write('The benchmarks got error responses: %s\n' % \
+                         ', '.join(output['failures']))
+        return 1
+
+    return 1 if output.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
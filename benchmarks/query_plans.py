@@ -0,0 +1,207 @@
+'''
+shows the query plans and timings of the dashboard, history and polling
+queries, and checks that they use the indexes of the filtered columns
+
+    python -m benchmarks.query_plans --rows 1000000 \\
+        --database sqlite:////tmp/medipay_benchmark.db --output plans.json
+
+the database is seeded only if it is empty
+'''
+import argparse
+import json
+import re
+import sys
+import time
+
+from sqlalchemy import desc
+from sqlalchemy.sql import func
+
+from project import db, models
+from project.one_tap.analytics import claims_rows
+
+from . import create_benchmark_app
+from .seed import seed
+
+
+def benchmark_queries():
+    '''
+    returns the (name, query, expected index) of the hot queries,
+    built the same way the views and services build them
+    '''
+    gop = models.GuaranteeOfPayment
+    claim = models.Claim
+
+    provider_id = 1
+    payer_id = 1
+
+    member = models.Member.query.get(1)
+    terminal = models.Terminal.query.get(1)
+
+    return [
+        ('dashboard_counts_provider',
+         db.session.query(gop.status, gop.final, func.count(gop.id))\
+            .filter(gop.closed == False, gop.provider_id == provider_id)\
+            .group_by(gop.status, gop.final),
+         'ix_guarantee_of_payment_provider_id_closed_status'),
+        ('dashboard_counts_payer',
+         db.session.query(gop.status, gop.final, func.count(gop.id))\
+            .filter(gop.closed == False, gop.payer_id == payer_id)\
+            .group_by(gop.status, gop.final),
+         'ix_guarantee_of_payment_payer_id_closed_status'),
+        ('dashboard_gops_provider',
+         gop.query.filter_by(provider_id=provider_id, closed=False,
+                             status='pending'),
+         'ix_guarantee_of_payment_provider_id_closed_status'),
+        ('history_provider',
+         gop.query.filter_by(provider_id=provider_id, closed=True)\
+            .limit(10),
+         'ix_guarantee_of_payment_provider_id_closed_status'),
+        ('history_payer',
+         gop.query.filter_by(payer_id=payer_id, closed=True).limit(10),
+         'ix_guarantee_of_payment_payer_id_closed_status'),
+        ('one_tap_claims_rows',
+         claims_rows(claim.query.filter_by(provider_id=provider_id)\
+                                .order_by(desc(claim.datetime))),
+         'ix_claim_provider_id_datetime'),
+        ('polling_new_claims',
+         claim.query.filter_by(new_claim=1),
+         'ix_claim_new_claim'),
+        ('terminal_by_device_uid',
+         models.Terminal.query.filter_by(device_uid=terminal.device_uid),
+         'ix_terminal_device_uid'),
+        ('member_by_device_uid',
+         models.Member.query.filter_by(device_uid=member.device_uid),
+         'ix_member_device_uid'),
+        ('member_by_national_id',
+         models.Member.query.filter_by(national_id=member.national_id),
+         'ix_member_national_id'),
+        ('chat_history_page',
+         models.ChatMessage.query.filter_by(chat_id=1)\
+            .order_by(models.ChatMessage.datetime.desc(),
+                      models.ChatMessage.id.desc()).limit(51),
+         'ix_chat_message_chat_id_datetime')
+    ]
+
+
+def compile_query(query):
+    '''
+    returns the SQL of the query and its parameters for the DB-API cursor
+    '''
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    params = compiled.params
+
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+
+    return (str(compiled), params)
+
+
+def explain(sql, params):
+    '''
+    returns the query plan rows and the names of the used indexes
+    '''
+    if db.engine.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+
+    connection = db.engine.raw_connection()
+
+    try:
+        cursor = connection.cursor()
+        cursor.execute(prefix + sql, params)
+        columns = [column[0] for column in cursor.description]
+        plan = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+    indexes = set()
+
+    for row in plan:
+        # MySQL reports the index in the 'key' column,
+        # SQLite in the detail text: 'USING INDEX ix_...'
+        if row.get('key'):
+            indexes.add(row['key'])
+        for name in re.findall(r'INDEX (\w+)', str(row.get('detail', ''))):
+            indexes.add(name)
+
+    return (plan, sorted(indexes))
+
+
+def time_query(query, repeat):
+    '''
+    returns the best time of the query out of the given runs, in ms
+    '''
+    best = None
+
+    for i in range(repeat):
+        start = time.time()
+        query.all()
+        elapsed = (time.time() - start) * 1000
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return round(best, 3)
+
+
+def run(repeat=5):
+    results = []
+
+    for name, query, expected_index in benchmark_queries():
+        sql, params = compile_query(query)
+        plan, indexes = explain(sql, params)
+
+        results.append({
+            'name': name,
+            'sql': sql,
+            'plan': plan,
+            'indexes': indexes,
+            'expected_index': expected_index,
+            'uses_index': expected_index in indexes,
+            'best_ms': time_query(query, repeat)
+        })
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database',
+                        default='sqlite:////tmp/medipay_benchmark.db',
+                        help='the url of the benchmark database')
+    parser.add_argument('--rows', type=int, default=1000000,
+                        help='the number of the claims and GOP requests')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='the number of runs of each query')
+    parser.add_argument('--output', help='the JSON file of the results')
+    args = parser.parse_args(argv)
+
+    app = create_benchmark_app(args.database)
+
+    with app.app_context():
+        db.create_all()
+
+        if not models.Claim.query.first():
+            seed(args.rows)
+
+        output = {
+            'database': db.engine.dialect.name,
+            'rows': models.Claim.query.count(),
+            'queries': run(repeat=args.repeat)
+        }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, default=str)
+    else:
+        json.dump(output, sys.stdout, indent=2, default=str)
+        sys.stdout.write('\n')
+
+    # fails if any of the queries doesn't use its index
+    return 0 if all(q['uses_index'] for q in output['queries']) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
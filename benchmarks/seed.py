@@ -0,0 +1,301 @@
+'''
+generates a realistic dataset of the given size for the benchmarks
+'''
+import random
+
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+from project import db, models
+
+
+# the number of rows inserted at a time
+BATCH_SIZE = 10000
+
+GOP_STATUSES = ['pending', 'in_review', 'approved', 'declined']
+CLAIM_STATUSES = ['Open', 'Closed']
+PATIENT_TYPES = ['in', 'out']
+COUNTRIES = ['Indonesia', 'Malaysia', 'Philippines', 'Singapore',
+             'Thailand', 'Vietnam']
+TERMS = ['fever', 'infection', 'fracture', 'diabetes', 'hypertension',
+         'asthma', 'migraine', 'pneumonia', 'gastritis', 'dermatitis',
+         'anemia', 'bronchitis', 'cholera', 'typhoid', 'dengue', 'malaria']
+
+# the users the benchmark logs in with, the provider and payer users
+# own the first provider and payer
+BENCHMARK_PASSWORD = 'benchmark'
+BENCHMARK_USERS = [
+    {'id': 1, 'email': 'admin@benchmark.local', 'role': 'admin',
+     'user_type': None, 'api_key': 'benchmark-admin-key'},
+    {'id': 2, 'email': 'provider@benchmark.local', 'role': 'user',
+     'user_type': 'provider', 'api_key': 'benchmark-provider-key'},
+    {'id': 3, 'email': 'payer@benchmark.local', 'role': 'user',
+     'user_type': 'payer', 'api_key': 'benchmark-payer-key'},
+]
+PROVIDER_USER_ID = 2
+PAYER_USER_ID = 3
+
+# the supported scale of the dataset
+MIN_ROWS = 1000
+MAX_ROWS = 1000000
+
+
+def scale_counts(rows):
+    '''
+    returns the number of rows of each table for the given scale,
+    the claims and GOP requests tables have the given number of rows
+    '''
+    return {
+        'provider': max(rows // 10000, 10),
+        'payer': max(rows // 20000, 5),
+        'member': max(rows // 10, 10),
+        'terminal': max(rows // 1000, 10),
+        'guarantee_of_payment': rows,
+        'claim': rows,
+        'icd_code': min(max(rows // 50, 100), 20000),
+        'chat': max(rows // 20, 10),
+        'chat_message': max(rows // 4, 10)
+    }
+
+
+def insert_rows(model, rows):
+    '''
+    inserts the generated rows of the model or the association
+    table with the batched insert statements
+    '''
+    table = getattr(model, '__table__', model)
+    batch = []
+
+    for row in rows:
+        batch.append(row)
+
+        if len(batch) >= BATCH_SIZE:
+            db.session.execute(table.insert(), batch)
+            batch = []
+
+    if batch:
+        db.session.execute(table.insert(), batch)
+
+    db.session.commit()
+
+
+def random_datetime(rnd, now, days=900):
+    return now - timedelta(seconds=rnd.randint(0, days * 86400))
+
+
+def user_rows():
+    password_hash = generate_password_hash(BENCHMARK_PASSWORD)
+
+    for user in BENCHMARK_USERS:
+        row = dict(user)
+        row.update({'password_hash': password_hash, 'premium': 1})
+        yield row
+
+
+def provider_rows(rnd, count):
+    for i in range(1, count + 1):
+        yield {
+            'id': i,
+            'company': 'Provider %d' % i,
+            'provider_type': rnd.choice(['hospital', 'clinic']),
+            'country': rnd.choice(COUNTRIES),
+            'user_id': PROVIDER_USER_ID if i == 1 else None
+        }
+
+
+def payer_rows(rnd, count):
+    for i in range(1, count + 1):
+        yield {
+            'id': i,
+            'company': 'Payer %d' % i,
+            'payer_type': rnd.choice(['insurance', 'tpa']),
+            'country': rnd.choice(COUNTRIES),
+            'user_id': PAYER_USER_ID if i == 1 else None
+        }
+
+
+def icd_code_rows(rnd, count):
+    for i in range(1, count + 1):
+        code = '%s%02d.%d' % (chr(ord('A') + (i // 1000) % 26),
+                              (i // 10) % 100, i % 10)
+
+        yield {
+            'id': i,
+            'code': code,
+            'edc': code,
+            'description': ' '.join(rnd.sample(TERMS, 3)),
+            'common_term': rnd.choice(TERMS)
+        }
+
+
+def provider_payer_rows(rnd, counts):
+    # the benchmark provider and payer always work together
+    for provider_id in range(1, counts['provider'] + 1):
+        payer_ids = set(rnd.sample(range(1, counts['payer'] + 1), 3))
+
+        if provider_id == 1:
+            payer_ids.add(1)
+
+        for payer_id in sorted(payer_ids):
+            yield {'provider_id': provider_id, 'payer_id': payer_id}
+
+
+def provider_member_rows(rnd, counts):
+    for member_id in range(1, counts['member'] + 1):
+        provider_ids = set(rnd.randint(1, counts['provider']) \
+                           for i in range(rnd.randint(1, 2)))
+
+        for provider_id in sorted(provider_ids):
+            yield {'provider_id': provider_id, 'member_id': member_id}
+
+
+def gop_icd_code_rows(rnd, counts):
+    for gop_id in range(1, counts['guarantee_of_payment'] + 1):
+        icd_code_ids = set(rnd.randint(1, counts['icd_code']) \
+                           for i in range(rnd.randint(1, 2)))
+
+        for icd_code_id in sorted(icd_code_ids):
+            yield {'guarantee_of_payment_id': gop_id,
+                   'icd_code_id': icd_code_id}
+
+
+def member_rows(rnd, count):
+    for i in range(1, count + 1):
+        yield {
+            'id': i,
+            'name': 'Member %d' % i,
+            'national_id': 'NID%09d' % i,
+            'policy_number': 'POL%09d' % i,
+            'patient_type': rnd.choice(PATIENT_TYPES),
+            'device_uid': 'member-%012x' % rnd.getrandbits(48)
+        }
+
+
+def terminal_rows(rnd, count, counts):
+    for i in range(1, count + 1):
+        yield {
+            'id': i,
+            'status': 'online',
+            'device_uid': 'terminal-%012x' % rnd.getrandbits(48),
+            'provider_id': rnd.randint(1, counts['provider'])
+        }
+
+
+def gop_rows(rnd, count, counts, now):
+    for i in range(1, count + 1):
+        timestamp = random_datetime(rnd, now)
+
+        # most of the requests are closed, like on the production
+        closed = rnd.random() < 0.9
+
+        yield {
+            'id': i,
+            'provider_id': rnd.randint(1, counts['provider']),
+            'payer_id': rnd.randint(1, counts['payer']),
+            'member_id': rnd.randint(1, counts['member']),
+            'reason': rnd.choice(TERMS),
+            'doctor_name': 'Doctor %d' % rnd.randint(1, 500),
+            'status': rnd.choice(GOP_STATUSES),
+            'closed': int(closed),
+            'final': int(rnd.random() < 0.3),
+            'quotation': round(rnd.uniform(50, 20000), 2),
+            'timestamp': timestamp,
+            'timestamp_edited': timestamp
+        }
+
+
+def claim_rows(rnd, count, counts, now):
+    for i in range(1, count + 1):
+        amount = round(rnd.uniform(10, 5000), 2)
+
+        yield {
+            'id': i,
+            'status': rnd.choice(CLAIM_STATUSES),
+            'claim_number': 'CLM%09d' % i,
+            'claim_type': 'Outpatient',
+            'datetime': random_datetime(rnd, now),
+            'amount': '%.2f' % amount,
+            'amount_value': amount,
+            'icd_code': 'A%02d.%d' % (rnd.randint(0, 99), rnd.randint(0, 9)),
+            'gop_id': i,
+            'provider_id': rnd.randint(1, counts['provider']),
+            'member_id': rnd.randint(1, counts['member']),
+            'terminal_id': rnd.randint(1, counts['terminal']),
+            # only the few claims are waiting to be polled
+            'new_claim': int(rnd.random() < 0.001)
+        }
+
+
+def chat_rows(rnd, count, counts):
+    # the chats of the GOP requests with the same ids
+    for i in range(1, count + 1):
+        yield {
+            'id': i,
+            'name': 'gop%d' % i,
+            'gop_id': i
+        }
+
+
+def chat_message_rows(rnd, count, counts, now):
+    for i in range(1, count + 1):
+        yield {
+            'id': i,
+            'text': 'Message %d about the %s' % (i, rnd.choice(TERMS)),
+            'chat_id': rnd.randint(1, counts['chat']),
+            'user_id': rnd.choice([PROVIDER_USER_ID, PAYER_USER_ID]),
+            'datetime': random_datetime(rnd, now, days=90)
+        }
+
+
+def analyze():
+    '''
+    updates the tables' statistics used by the query planner
+    '''
+    if db.engine.dialect.name == 'mysql':
+        for table in ['user', 'provider', 'payer', 'member', 'terminal',
+                      'guarantee_of_payment', 'claim', 'icd_code', 'chat',
+                      'chat_message', 'custom_payers', 'custom_members',
+                      'custom_icd_codes']:
+            db.session.execute('ANALYZE TABLE `%s`' % table)
+    else:
+        db.session.execute('ANALYZE')
+
+    db.session.commit()
+
+
+def seed(rows, random_seed=0):
+    '''
+    creates the schema and fills an empty database,
+    the same seed always generates the same data
+    '''
+    rnd = random.Random(random_seed)
+    now = datetime.now()
+    counts = scale_counts(rows)
+
+    if not MIN_ROWS <= rows <= MAX_ROWS:
+        raise ValueError('The number of rows should be from %d to %d' % (
+            MIN_ROWS, MAX_ROWS))
+
+    db.create_all()
+
+    insert_rows(models.User, user_rows())
+    insert_rows(models.Provider, provider_rows(rnd, counts['provider']))
+    insert_rows(models.Payer, payer_rows(rnd, counts['payer']))
+    insert_rows(models.Member, member_rows(rnd, counts['member']))
+    insert_rows(models.Terminal,
+                terminal_rows(rnd, counts['terminal'], counts))
+    insert_rows(models.GuaranteeOfPayment,
+                gop_rows(rnd, counts['guarantee_of_payment'], counts, now))
+    insert_rows(models.Claim, claim_rows(rnd, counts['claim'], counts, now))
+    insert_rows(models.ICDCode, icd_code_rows(rnd, counts['icd_code']))
+    insert_rows(models.custom_payers, provider_payer_rows(rnd, counts))
+    insert_rows(models.custom_members, provider_member_rows(rnd, counts))
+    insert_rows(models.custom_icd_codes, gop_icd_code_rows(rnd, counts))
+    insert_rows(models.Chat, chat_rows(rnd, counts['chat'], counts))
+    insert_rows(models.ChatMessage,
+                chat_message_rows(rnd, counts['chat_message'], counts, now))
+
+    analyze()
+
+    return counts
@@ -16,5 +16,57 @@ def make_shell_context():
 manager.add_command('shell', Shell(make_context=make_shell_context))
 manager.add_command('db', MigrateCommand)
 
+
+def require_production(command):
+    '''the workers share the app's database and Redis,
+    so they aren't run with the development SQLite database'''
+    config_name = os.getenv('FLASK_CONFIG') or 'default'
+    database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+
+    if config_name != 'production' or database_uri.startswith('sqlite'):
+        raise SystemExit('The %s runs with FLASK_CONFIG=production and the '
+                         'production database only, the "%s" config with '
+                         '%s is used' % (command, config_name,
+                                         database_uri.split(':')[0]))
+
+
+@manager.command
+def reindex_search():
+    '''Rebuilds the GOP requests search index in Redis'''
+    from project.main.services import gop_search_service
+    gop_search_service.rebuild()
+
+
+@manager.command
+def reload_icd_codes():
+    '''Makes the running app reload its ICD codes index,
+    run it after importing the ICD codes into the database'''
+    from project.main.services import icd_code_index
+    icd_code_index.invalidate()
+
+
+@manager.command
+def rebuild_gop_counters():
+    '''Recounts the open GOP requests counters in Redis'''
+    from project.main.services import gop_counters_service
+    gop_counters_service.rebuild()
+
+
+@manager.command
+def mail_worker():
+    '''Sends the queued emails, run one worker for the app'''
+    require_production('mail worker')
+    from project.mail_queue import MailWorker
+    MailWorker(app).run()
+
+
+@manager.command
+def chat_flusher():
+    '''Saves the chat messages buffered in Redis to the database'''
+    require_production('chat flusher')
+    from project.chat_flusher import ChatFlusher
+    ChatFlusher(app).run()
+
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
@@ -0,0 +1,108 @@
+"""numeric claim amount
+
+Revision ID: 3f2a9c1d7b4e
+Revises:
+Create Date: 2026-10-18 11:24:37.412906
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import logging
+
+from decimal import Decimal, InvalidOperation
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2a9c1d7b4e'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic.env')
+
+# the number of claims converted at a time
+BATCH_SIZE = 1000
+
+# a copy of project.models.to_decimal_or_none as of this revision,
+# so the migration doesn't change with the app's models
+def to_decimal_or_none(value):
+    if value is None:
+        return None
+
+    value = value.replace(',', '').replace('$', '').strip()
+
+    try:
+        value = Decimal(value)
+
+        if not value.is_finite():
+            return None
+
+        value = value.quantize(Decimal('0.01'))
+
+        # the amount must fit the NUMERIC(12, 2) column
+        if abs(value) >= Decimal('1e10'):
+            return None
+    except (InvalidOperation, ValueError):
+        return None
+
+    return value
+
+
+claim = sa.table('claim',
+                 sa.column('id', sa.Integer),
+                 sa.column('amount', sa.String(127)),
+                 sa.column('amount_value', sa.Numeric(12, 2)))
+
+
+def upgrade():
+    op.add_column('claim', sa.Column('amount_value', sa.Numeric(12, 2),
+                                     nullable=True))
+
+    connection = op.get_bind()
+    update = claim.update()\
+        .where(claim.c.id == sa.bindparam('claim_id'))\
+        .values(amount_value=sa.bindparam('value'))
+
+    last_id = 0
+    converted = 0
+    invalid = []
+
+    # convert the amount strings in the batches of the claims' ids
+    while True:
+        rows = connection.execute(
+            sa.select([claim.c.id, claim.c.amount])\
+                .where(claim.c.id > last_id)\
+                .order_by(claim.c.id)\
+                .limit(BATCH_SIZE)).fetchall()
+
+        if not rows:
+            break
+
+        values = []
+
+        for claim_id, amount in rows:
+            value = to_decimal_or_none(amount)
+
+            if value is not None:
+                values.append({'claim_id': claim_id, 'value': value})
+            elif amount is not None and amount.strip():
+                invalid.append(claim_id)
+
+        if values:
+            connection.execute(update, values)
+
+        converted += len(values)
+        last_id = rows[-1][0]
+
+    logger.info('Converted the amounts of %d claims.', converted)
+
+    # the invalid amounts are left as they are and have no numeric value
+    if invalid:
+        logger.warning('%d claims have invalid amounts and no numeric '
+                       'value, claim ids: %s', len(invalid),
+                       ', '.join(str(i) for i in invalid[:100]))
+
+
+def downgrade():
+    op.drop_column('claim', 'amount_value')
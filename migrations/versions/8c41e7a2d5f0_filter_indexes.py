@@ -0,0 +1,41 @@
+"""filter indexes
+
+Revision ID: 8c41e7a2d5f0
+Revises: 3f2a9c1d7b4e
+Create Date: 2026-10-18 15:02:11.583214
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8c41e7a2d5f0'
+down_revision = '3f2a9c1d7b4e'
+branch_labels = None
+depends_on = None
+
+
+# (index name, table, columns)
+INDEXES = [
+    ('ix_guarantee_of_payment_provider_id_closed_status',
+     'guarantee_of_payment', ['provider_id', 'closed', 'status']),
+    ('ix_guarantee_of_payment_payer_id_closed_status',
+     'guarantee_of_payment', ['payer_id', 'closed', 'status']),
+    ('ix_claim_provider_id_datetime', 'claim', ['provider_id', 'datetime']),
+    ('ix_claim_new_claim', 'claim', ['new_claim']),
+    ('ix_claim_claim_number', 'claim', ['claim_number']),
+    ('ix_member_device_uid', 'member', ['device_uid']),
+    ('ix_member_national_id', 'member', ['national_id']),
+    ('ix_terminal_device_uid', 'terminal', ['device_uid']),
+    ('ix_user_api_key', 'user', ['api_key']),
+]
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, unique=False)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
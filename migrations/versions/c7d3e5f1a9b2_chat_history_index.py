@@ -0,0 +1,25 @@
+"""chat history index
+
+Revision ID: c7d3e5f1a9b2
+Revises: 8c41e7a2d5f0
+Create Date: 2026-10-18 17:21:45.107392
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d3e5f1a9b2'
+down_revision = '8c41e7a2d5f0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_chat_message_chat_id_datetime', 'chat_message',
+                    ['chat_id', 'datetime', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_chat_message_chat_id_datetime',
+                  table_name='chat_message')
@@ -6,16 +6,16 @@ from flask_cors import CORS, cross_origin
 from flask_redis import FlaskRedis
 from flask_login import LoginManager
 from flask_login import current_user
-from flask_mail import Mail
 from flask_sqlalchemy import SQLAlchemy
 from flask_socketio import SocketIO
 
 from .config import config
+from .metrics import InstrumentedMail, InstrumentedRedis
 
 db = SQLAlchemy()
-mail = Mail()
+mail = InstrumentedMail()
 socketio = SocketIO()
-redis_store = FlaskRedis()
+redis_store = FlaskRedis.from_custom_provider(InstrumentedRedis)
 login_manager = LoginManager()
 login_manager.login_view = 'auth.login'
 login_manager.session_protection = 'strong'
@@ -36,7 +36,9 @@ def create_app(config_name):
 
     db.init_app(app)
     redis_store.init_app(app)
-    socketio.init_app(app)
+    message_queue = app.config['REDIS_URL'] \
+        if app.config['SOCKETIO_MESSAGE_QUEUE'] else None
+    socketio.init_app(app, message_queue=message_queue)
     mail.init_app(app)
     login_manager.init_app(app)
 
@@ -58,5 +60,13 @@ def create_app(config_name):
     from .one_tap import one_tap as one_tap_blueprint
     app.register_blueprint(one_tap_blueprint, url_prefix='/1tap')
 
+    # the instrumentation imports the main package's helpers,
+    # so it's set up after the blueprints are imported
+    from . import instrumentation
+    instrumentation.init_app(app)
+
+    from . import metrics
+    metrics.init_app(app)
+
     from . import models
     return app
@@ -10,7 +10,8 @@ from .forms import ChangeProviderInfoForm, ChangePayerInfoForm
 from .forms import ProviderPayerSetupAddForm, ProviderPayerSetupEditForm
 from .forms import BillingCodeForm, SingleCsvForm, DoctorForm, UserSetupForm
 from .forms import UserSetupAdminForm, UserUpgradeForm, EditAccountForm
-from .. import models, db, mail
+from .. import models, db, mail_queue
+from ..api.helpers import invalidate_api_key
 from ..main.helpers import photo_file_name_santizer, to_float_or_zero
 from ..main.helpers import validate_email_address
 from ..main.services import PayerService
@@ -715,8 +716,8 @@ def user_upgrade():
                                         email_invoice=form.email.data)
 
         # send the emails
-        mail.send(admin_msg)
-        mail.send(user_msg)
+        mail_queue.enqueue(admin_msg)
+        mail_queue.enqueue(user_msg)
 
         flash('Your request for a Premium account has been sent.')
         return redirect(url_for('main.index'))
@@ -732,6 +733,9 @@ def generate_api_key():
     '''
     api_key = pass_generator(size=16)
 
+    # the old key must stop working right away
+    invalidate_api_key(current_user.api_key)
+
     current_user.api_key = api_key
     db.session.add(current_user)
 
@@ -9,7 +9,8 @@ from ..account.forms import ProviderPayerSetupAddForm, ProviderPayerSetupEditFor
 from ..account.forms import SingleCsvForm, BillingCodeForm, DoctorForm
 from ..account.forms import UserSetupAdminForm, EditAccountAdminForm
 from ..main.services import GuaranteeOfPaymentService, UserService
-from .. import models, db
+from ..main.services import gop_counters_service, gop_statistics_service
+from .. import instrumentation, models, db
 from ..models import login_required
 
 gop_service = GuaranteeOfPaymentService()
@@ -26,45 +27,20 @@ def index():
     gops = models.GuaranteeOfPayment.query.filter(
             not models.GuaranteeOfPayment.closed)
 
-    in_review_count = models.GuaranteeOfPayment.query.filter_by(
-        status='in_review').filter(
-        not models.GuaranteeOfPayment.closed).count()
-    approved_count = models.GuaranteeOfPayment.query.filter_by(
-        status='approved').filter(
-        not models.GuaranteeOfPayment.closed).count()
-    rejected_count = models.GuaranteeOfPayment.query.filter_by(
-        status='declined').filter(
-        not models.GuaranteeOfPayment.closed).count()
-    total_count = gops.count()
+    counts = gop_statistics_service.counts(current_user)
+
+    in_review_count = counts['in_review']
+    approved_count = counts['approved']
+    rejected_count = counts['declined']
+    total_count = counts['total']
     pending_count = total_count - (approved_count + rejected_count + \
         in_review_count)
 
-    # count all GOP's by its providers' country
-    by_country_count = db.session\
-        .query(models.Provider.country, db.func.count(
-            models.Provider.country))\
-        .join(models.GuaranteeOfPayment,
-              models.GuaranteeOfPayment.provider_id == models.Provider.id)\
-        .group_by(models.Provider.country)\
-        .filter(not models.GuaranteeOfPayment.closed).all()
-
-    # count all GOP's by its providers' company
-    by_provider_count = db.session\
-        .query(models.Provider.company, db.func.count(
-            models.Provider.company))\
-        .join(models.GuaranteeOfPayment,
-              models.GuaranteeOfPayment.provider_id == models.Provider.id)\
-        .group_by(models.Provider.company)\
-        .filter(not models.GuaranteeOfPayment.closed).all()
-
-    # count all GOP's by its payers's company
-    by_payer_count = db.session\
-        .query(models.Payer.company, db.func.count(
-            models.Payer.company))\
-        .join(models.GuaranteeOfPayment,
-              models.GuaranteeOfPayment.payer_id == models.Payer.id)\
-        .group_by(models.Payer.company)\
-        .filter(not models.GuaranteeOfPayment.closed).all()
+    # the GOP's counters by providers' country, providers' and payers'
+    # company are maintained on write, so they are read without counting
+    by_country_count = gop_counters_service.by_country()
+    by_provider_count = gop_counters_service.by_provider()
+    by_payer_count = gop_counters_service.by_payer()
 
     today = datetime.now()
 
@@ -88,6 +64,22 @@ def index():
     return render_template('index.html', **context)
 
 
+@admin.route('/perf', methods=['GET', 'POST'])
+@login_required(roles=['admin'])
+def perf():
+    '''
+    the queries count and the database time of the endpoints
+    '''
+    if request.method == 'POST':
+        instrumentation.reset()
+        flash('The performance figures have been reset.')
+        return redirect(url_for('admin.perf'))
+
+    endpoints = instrumentation.endpoints_stats()
+
+    return render_template('perf.html', endpoints=endpoints)
+
+
 @admin.route('/requests/by/<by>')
 @login_required(roles=['admin'])
 def requests_sorted(by):
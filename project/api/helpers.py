@@ -1,7 +1,17 @@
-from flask import request
+import json
+import time
+
+from collections import OrderedDict
+
+from flask import current_app, jsonify, request, Response
+from flask import stream_with_context
 from flask_login import current_user
 
-from .. import db, models
+from .. import db, models, redis_store
+
+
+# in-process cache of the API keys: {api_key: (user_id, expires_at)}
+api_key_cache = OrderedDict()
 
 # prepare models dictionaries
 def prepare_gop_dict(gop):
@@ -260,11 +270,115 @@ def prepare_user_dict(user):
     return user_dict
 
 
+def date_to_str(value, date_format='%m/%d/%Y'):
+    '''
+    Formats the date for the JSON response, None stays None
+    '''
+    if not value:
+        return None
+
+    return value.strftime(date_format)
+
+
+def prepare_member_dict(member):
+    '''
+    The function takes the Member model object
+    and convert it to the python dictionary
+    '''
+    if not member:
+        return None
+
+    member_dict = {
+        'id': member.id,
+        'photo': member.photo,
+        'name': member.name,
+        'email': member.email,
+        'action': member.action,
+        'address': member.address,
+        'address_additional': member.address_additional,
+        'tel': member.tel,
+        'dob': date_to_str(member.dob),
+        'gender': member.gender,
+        'marital_status': member.marital_status,
+        'start_date': date_to_str(member.start_date),
+        'effective_date': date_to_str(member.effective_date),
+        'mature_date': date_to_str(member.mature_date),
+        'exit_date': date_to_str(member.exit_date),
+        'product': member.product,
+        'plan': member.plan,
+        'policy_number': member.policy_number,
+        'national_id': member.national_id,
+        'card_number': member.card_number,
+        'plan_type': member.plan_type,
+        'remarks': member.remarks,
+        'dependents': member.dependents,
+        'sequence': member.sequence,
+        'patient_type': member.patient_type,
+        'device_uid': member.device_uid,
+        'user_id': member.user_id
+    }
+
+    return member_dict
+
+
+def prepare_terminal_dict(terminal):
+    '''
+    The function takes the Terminal model object
+    and convert it to the python dictionary
+    '''
+    if not terminal:
+        return None
+
+    terminal_dict = {
+        'id': terminal.id,
+        'status': terminal.status,
+        'serial_number': terminal.serial_number,
+        'model': terminal.model,
+        'location': terminal.location,
+        'version': terminal.version,
+        'last_update': date_to_str(terminal.last_update),
+        'remarks': terminal.remarks,
+        'device_uid': terminal.device_uid,
+        'provider_id': terminal.provider_id
+    }
+
+    return terminal_dict
+
+
+def prepare_claim_dict(claim):
+    '''
+    The function takes the Claim model object
+    and convert it to the python dictionary
+    '''
+    if not claim:
+        return None
+
+    claim_dict = {
+        'id': claim.id,
+        'status': claim.status,
+        'claim_number': claim.claim_number,
+        'claim_type': claim.claim_type,
+        'datetime': date_to_str(claim.datetime),
+        'admitted': claim.admitted,
+        'discharged': claim.discharged,
+        'amount': claim.amount,
+        'icd_code': claim.icd_code,
+        'gop_id': claim.gop_id,
+        'provider_id': claim.provider_id,
+        'member_id': claim.member_id,
+        'terminal_id': claim.terminal_id
+    }
+
+    return claim_dict
+
+
 # prepare models lists
 def prepare_gops_list(gops):
     '''
     This function takes the GOP model objects list and convert 
-    it to the list of python dictionary
+    it to the list of python dictionary.
+    Load the GOPs with GuaranteeOfPaymentService.eager_load() first,
+    otherwise each GOP lazy loads its provider, payer, member and ICD codes
     '''
 
     if not gops:
@@ -380,6 +494,160 @@ def prepare_users_list(users):
     return results
 
 
+def prepare_members_list(members):
+    '''
+    This function takes the Member model objects list and convert
+    it to the list of python dictionary
+    '''
+    if not members:
+        return []
+
+    results = [] # Initialize the results list
+
+    for member in members:
+        results.append(prepare_member_dict(member))
+
+    return results
+
+
+def prepare_terminals_list(terminals):
+    '''
+    This function takes the Terminal model objects list and convert
+    it to the list of python dictionary
+    '''
+    if not terminals:
+        return []
+
+    results = [] # Initialize the results list
+
+    for terminal in terminals:
+        results.append(prepare_terminal_dict(terminal))
+
+    return results
+
+
+def prepare_claims_list(claims):
+    '''
+    This function takes the Claim model objects list and convert
+    it to the list of python dictionary
+    '''
+    if not claims:
+        return []
+
+    results = [] # Initialize the results list
+
+    for claim in claims:
+        results.append(prepare_claim_dict(claim))
+
+    return results
+
+
+def is_keyset_request():
+    '''
+    Checks if the client asks for a page of the list
+    instead of the whole list
+    '''
+    return 'after_id' in request.args or 'limit' in request.args
+
+
+def keyset_paginate(query, model):
+    '''
+    Returns the page of the query objects following the "after_id"
+    cursor and the cursor of the next page. The page is selected by
+    the primary key index, so the cost of the page doesn't grow
+    with the table
+    '''
+    page_size = current_app.config['API_PAGE_SIZE']
+    max_page_size = current_app.config['API_MAX_PAGE_SIZE']
+
+    try:
+        after_id = int(request.args.get('after_id') or 0)
+    except (ValueError, TypeError):
+        after_id = 0
+
+    try:
+        limit = int(request.args.get('limit') or page_size)
+    except (ValueError, TypeError):
+        limit = page_size
+
+    limit = max(1, min(limit, max_page_size))
+
+    if after_id:
+        query = query.filter(model.id > after_id)
+
+    # fetch one object more to know if there is the next page
+    items = query.order_by(model.id).limit(limit + 1).all()
+
+    next_cursor = None
+
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = items[-1].id
+
+    return (items, next_cursor)
+
+
+def keyset_response(query, model, prepare_list, exclude=None):
+    '''
+    Serializes the query objects to JSON. If the client asks for a page
+    with "after_id" or "limit" parameters, the page is returned together
+    with the "next_cursor", otherwise the whole list is returned
+    '''
+    if not is_keyset_request():
+        return jsonify(exclude_keys(exclude, prepare_list(query.all())))
+
+    items, next_cursor = keyset_paginate(query, model)
+
+    return jsonify({
+        'results': exclude_keys(exclude, prepare_list(items)),
+        'next_cursor': next_cursor
+    })
+
+
+def is_ndjson_request():
+    '''
+    Checks if the client asks for the streaming NDJSON export
+    '''
+    return request.args.get('format') == 'ndjson'
+
+
+def iterate_in_chunks(query, model, chunk_size):
+    '''
+    Yields the query objects chunk by chunk, walking the primary key index.
+    Only one chunk is held in memory and the eager loading options
+    of the query still apply to each chunk
+    '''
+    last_id = 0
+
+    while True:
+        chunk = query.filter(model.id > last_id)\
+                     .order_by(model.id).limit(chunk_size).all()
+
+        if not chunk:
+            break
+
+        for item in chunk:
+            yield item
+
+        last_id = chunk[-1].id
+
+
+def ndjson_response(query, model, prepare_dict):
+    '''
+    Streams the query objects as NDJSON, one serialized object per line.
+    The first rows are sent before the rest of the table is read
+    '''
+    chunk_size = current_app.config['API_STREAM_CHUNK_SIZE']
+    encoder = current_app.json_encoder
+
+    def generate():
+        for item in iterate_in_chunks(query, model, chunk_size):
+            yield json.dumps(prepare_dict(item), cls=encoder) + '\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
 def from_post_to_dict(dest_dict, overwrite=False):
     '''
     Converts post data to python dictionary object
@@ -426,6 +694,84 @@ def from_json_to_dict(json_dict, dest_dict, overwrite=False):
     return dest_dict
 
 
+def api_key_redis_name(api_key):
+    '''
+    Returns the Redis key under which the API key's user id is cached
+    '''
+    return 'api_key:%s' % api_key
+
+
+def get_cached_api_key(api_key):
+    '''
+    Returns the cached user id of the API key, first looking in the
+    process cache, then in Redis. Returns None if the key is not cached
+    '''
+    cached = api_key_cache.get(api_key)
+
+    if cached:
+        user_id, expires_at = cached
+
+        if expires_at > time.time():
+            # mark the key as the most recently used
+            del api_key_cache[api_key]
+            api_key_cache[api_key] = cached
+            return user_id
+
+        del api_key_cache[api_key]
+
+    # try reading the key from redis server
+    try:
+        user_id = redis_store.get(api_key_redis_name(api_key))
+    except:
+        user_id = None
+
+    if user_id:
+        user_id = int(user_id)
+        cache_api_key(api_key, user_id, to_redis=False)
+        return user_id
+
+    return None
+
+
+def cache_api_key(api_key, user_id, to_redis=True):
+    '''
+    Caches the user id of the API key in the process cache
+    and in Redis
+    '''
+    ttl = current_app.config['API_KEY_CACHE_TTL']
+
+    api_key_cache.pop(api_key, None)
+    api_key_cache[api_key] = (user_id, time.time() + ttl)
+
+    # drop the least recently used keys
+    while len(api_key_cache) > current_app.config['API_KEY_CACHE_SIZE']:
+        api_key_cache.popitem(last=False)
+
+    if to_redis:
+        try:
+            redis_store.setex(api_key_redis_name(api_key),
+                              current_app.config['API_KEY_REDIS_TTL'],
+                              user_id)
+        except:
+            pass
+
+
+def invalidate_api_key(api_key):
+    '''
+    Removes the API key from the process cache and from Redis,
+    should be called when the user's API key is changed
+    '''
+    if not api_key:
+        return
+
+    api_key_cache.pop(api_key, None)
+
+    try:
+        redis_store.delete(api_key_redis_name(api_key))
+    except:
+        pass
+
+
 def authorize_api_key():
     '''
     Authenticates API key
@@ -436,7 +782,23 @@ def authorize_api_key():
         # failure, return error, no user object
         return (False, 'API key is missing', None)
 
-    user = models.User.query.filter_by(api_key=api_key).first()
+    user = None
+    user_id = get_cached_api_key(api_key)
+
+    if user_id:
+        user = models.User.query.get(user_id)
+
+        # the key could be regenerated by another process,
+        # so the cached user is checked against the database row
+        if not user or user.api_key != api_key:
+            invalidate_api_key(api_key)
+            user = None
+
+    if not user:
+        user = models.User.query.filter_by(api_key=api_key).first()
+
+        if user:
+            cache_api_key(api_key, user.id)
 
     if not user:
         # failure, return error, no user object
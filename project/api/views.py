@@ -10,8 +10,9 @@ import requests
 from datetime import datetime
 from functools import wraps
 
-from flask import jsonify, request, render_template, url_for
+from flask import g, jsonify, request, render_template, url_for
 from sqlalchemy import desc
+from werkzeug.local import LocalProxy
 
 from .helpers import *
 from . import api
@@ -22,6 +23,9 @@ from .. import config, db, models
 
 gop_service = GuaranteeOfPaymentService()
 
+# the user of the request's API key, set by the api_auth decorator
+user = LocalProxy(lambda: g.api_user)
+
 
 def api_auth():
     '''
@@ -30,9 +34,10 @@ def api_auth():
     def wrapper(fn):
         @wraps(fn)
         def decorated_view(*args, **kwargs):
-            authorized, error, user = authorize_api_key()
+            authorized, error, api_user = authorize_api_key()
             if not authorized:
                 return error
+            g.api_user = api_user
             return fn(*args, **kwargs)
         return decorated_view
     return wrapper
@@ -55,21 +60,30 @@ def validate_email_address(data):
 @api.route('/requests', methods=['GET'])
 @api_auth()
 def requests():
-    '''The function returns all the GOP requests'''
+    '''The function returns all the GOP requests,
+    or a page of them if "after_id" or "limit" is given'''
 
     if user.user_type == 'provider':
         gops = models.GuaranteeOfPayment.query.filter_by(
-            provider=user.provider).all()
+            provider=user.provider)
 
     elif user.user_type == 'payer':
         gops = models.GuaranteeOfPayment.query.filter_by(
-            payer=user.payer).all()
+            payer=user.payer)
 
     else:
         return 'Error: no user is found.'
 
+    # load the GOPs with their relations in a batch
+    gops = gop_service.eager_load(gops)
+
+    if is_ndjson_request():
+        return ndjson_response(gops, models.GuaranteeOfPayment,
+                               prepare_gop_dict)
+
     # return the result in a JSON format
-    return jsonify(prepare_gops_list(gops))
+    return keyset_response(gops, models.GuaranteeOfPayment,
+                           prepare_gops_list)
 
 
 @api.route('/request/<int:gop_id>', methods=['GET'])
@@ -151,10 +165,11 @@ def payers():
             'providers',
             'guarantees_of_payment'
         ]
-        payers_list = exclude_keys(exclude,
-                                   prepare_payers_list(user.provider.payers))
+        payers = models.Payer.query.filter(
+            models.Payer.providers.any(id=user.provider.id))
 
-        return jsonify(payers_list)
+        return keyset_response(payers, models.Payer, prepare_payers_list,
+                               exclude=exclude)
 
     elif user.user_type == 'payer':
         return 'Error: the payer does not have payers'
@@ -238,9 +253,9 @@ def icd_codes():
     '''
     returns a list of icd codes
     '''
-    icd_codes = models.ICDCode.query.all()
+    icd_codes = models.ICDCode.query
 
-    return jsonify(prepare_icd_codes_list(icd_codes))
+    return keyset_response(icd_codes, models.ICDCode, prepare_icd_codes_list)
 
 
 @api.route('/icd-code/<int:icd_code_id>', methods=['GET'])
@@ -1342,10 +1357,13 @@ def account_settings_edit():
 def members():
     '''The function returns all the members'''
 
-    members = models.Member.query.all()
+    members = models.Member.query
+
+    if is_ndjson_request():
+        return ndjson_response(members, models.Member, prepare_member_dict)
 
     # return the result in a JSON format
-    return jsonify(prepare_members_list(members))
+    return keyset_response(members, models.Member, prepare_members_list)
 
 
 @api.route('/member/<int:member_id>', methods=['GET'])
@@ -1369,10 +1387,10 @@ def member_get(member_id):
 def users():
     '''The function returns all the users'''
 
-    users = models.User.query.all()
+    users = models.User.query
 
     # return the result in a JSON format
-    return jsonify(prepare_users_list(users))
+    return keyset_response(users, models.User, prepare_users_list)
 
 
 @api.route('/user/<int:user_id>', methods=['GET'])
@@ -1396,10 +1414,10 @@ def user_get(user_id):
 def terminals():
     '''The function returns all the terminals'''
 
-    terminals = models.Terminal.query.all()
+    terminals = models.Terminal.query
 
     # return the result in a JSON format
-    return jsonify(prepare_terminals_list(terminals))
+    return keyset_response(terminals, models.Terminal, prepare_terminals_list)
 
 
 @api.route('/terminal/<int:terminal_id>', methods=['GET'])
@@ -1423,10 +1441,13 @@ def terminal_get(terminal_id):
 def claim():
     '''The function returns all the claims'''
 
-    claims = models.Claim.query.all()
+    claims = models.Claim.query
+
+    if is_ndjson_request():
+        return ndjson_response(claims, models.Claim, prepare_claim_dict)
 
     # return the result in a JSON format
-    return jsonify(prepare_claims_list(claims))
+    return keyset_response(claims, models.Claim, prepare_claims_list)
 
 
 @api.route('/claim/<int:claim_id>', methods=['GET'])
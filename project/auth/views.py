@@ -9,7 +9,7 @@ from flask_mail import Message
 
 from . import auth
 from .forms import LoginForm, RegistrationForm, ForgotPasswordForm
-from .. import mail
+from .. import mail_queue
 from ..models import db, User, Provider, Payer
 
 
@@ -159,7 +159,7 @@ def forgot_password():
         Password: %s</p>
         """ % (user.email, rand_pass)
 
-        mail.send(msg)
+        mail_queue.enqueue(msg, sensitive=True)
         flash('Please, check your email for a new password.')
         return redirect(url_for('auth.login'))
 
@@ -0,0 +1,275 @@
+'''
+the write-behind persistence of the chat messages
+
+the 'text' Socket.IO handler pushes the messages to the Redis lists
+of the room's users (gopNuserM) and registers the lists in a set, the
+flusher (python manage.py chat_flusher) saves them to the database with
+bulk inserts every few seconds or as soon as a list grows large. The
+messages are removed from the lists only after they are committed, so
+a crashed flusher saves them on its next run
+'''
+import json
+import re
+import time
+
+from collections import Counter
+
+import dateutil.parser
+
+from flask import current_app
+
+from . import db, redis_store
+from .main.helpers import to_str
+from .models import Chat, ChatMessage, User
+
+
+# the set of the lists, which have the messages to be saved
+CHAT_BUFFERS = 'chat:buffers'
+
+# the list the 'text' handler pushes to, when a buffer is large enough
+# to be saved before the next flush
+CHAT_FLUSH_SIGNAL = 'chat:flush'
+
+BUFFER_PATTERN = re.compile(r'^gop(\d+)user(\d+)$')
+
+
+def buffer_key(room, user_id):
+    return '%suser%d' % (room, user_id)
+
+
+def parse_buffer_key(key):
+    '''
+    returns the (room, user id) of the list or None
+    '''
+    match = BUFFER_PATTERN.match(to_str(key))
+
+    if not match:
+        return None
+
+    return ('gop' + match.group(1), int(match.group(2)))
+
+
+def buffer_message(room, user_id, message_json):
+    '''
+    pushes the message to the user's list, wakes up the flusher,
+    if the list has grown larger than the flush size
+    '''
+    key = buffer_key(room, user_id)
+
+    pipe = redis_store.pipeline()
+    pipe.rpush(key, message_json)
+    pipe.sadd(CHAT_BUFFERS, key)
+    length, _ = pipe.execute()
+
+    if length >= current_app.config['CHAT_FLUSH_SIZE']:
+        redis_store.lpush(CHAT_FLUSH_SIGNAL, key)
+
+
+def load_message(message_json):
+    message = json.loads(to_str(message_json))
+    message['datetime'] = dateutil.parser.parse(message['datetime'])
+
+    return message
+
+
+def buffered_messages(room):
+    '''
+    returns the messages of the room, which aren't saved yet,
+    from the oldest to the newest, together with the authors' emails
+    '''
+    try:
+        keys = [key for key in redis_store.smembers(CHAT_BUFFERS) \
+                if (parse_buffer_key(key) or (None,))[0] == room]
+
+        if not keys:
+            return []
+
+        pipe = redis_store.pipeline(transaction=False)
+
+        for key in keys:
+            pipe.lrange(key, 0, -1)
+
+        messages = [load_message(message_json) \
+                    for messages in pipe.execute() \
+                    for message_json in messages]
+    except:
+        return []
+
+    user_ids = set(message['user_id'] for message in messages)
+    emails = dict(db.session.query(User.id, User.email)\
+                            .filter(User.id.in_(user_ids)).all()) \
+        if user_ids else {}
+
+    messages.sort(key=lambda message: message['datetime'])
+
+    return [{
+        'name': emails.get(message['user_id']),
+        'msg': message['message'],
+        'datetime': message['datetime'].strftime('%I:%M:%S %p %d/%m/%Y')
+    } for message in messages]
+
+
+def merge_history(saved, buffered):
+    '''
+    appends the buffered messages to the saved ones, except the ones
+    committed by the flusher, but not yet removed from their lists
+    '''
+    def message_key(message):
+        return (message['name'], message['msg'], message['datetime'])
+
+    committed = Counter(message_key(message) for message in saved)
+    messages = list(saved)
+
+    for message in buffered:
+        key = message_key(message)
+
+        if committed[key]:
+            committed[key] -= 1
+        else:
+            messages.append(message)
+
+    return messages
+
+
+class ChatFlusher(object):
+    '''
+    saves the buffered chat messages to the database
+    '''
+    def __init__(self, app):
+        self.app = app
+        self.config = app.config
+
+    def register_existing_buffers(self):
+        '''
+        adds the lists left by the older versions of the app to the set
+        '''
+        keys = [key for key in redis_store.scan_iter(match='gop*user*') \
+                if parse_buffer_key(key)]
+
+        if keys:
+            redis_store.sadd(CHAT_BUFFERS, *keys)
+
+    def take(self, key):
+        '''
+        returns up to the batch size of the oldest messages of the list,
+        they stay in the list until they are committed
+        '''
+        size = self.config['CHAT_FLUSH_BATCH_SIZE']
+
+        return redis_store.lrange(key, 0, size - 1)
+
+    def remove_committed(self, taken):
+        '''
+        removes the committed messages from the heads of their lists,
+        the handlers only push the new messages to the tails
+        '''
+        pipe = redis_store.pipeline()
+
+        for key, (room, messages) in taken.items():
+            pipe.ltrim(key, len(messages), -1)
+
+        pipe.execute()
+
+    def unregister_if_empty(self, key):
+        '''
+        removes the list from the set, unless a message
+        has been pushed to it in the meantime
+        '''
+        def unregister(pipe):
+            if pipe.llen(key) == 0:
+                pipe.multi()
+                pipe.srem(CHAT_BUFFERS, key)
+
+        # retried by redis-py, if the list changes before EXEC
+        redis_store.transaction(unregister, key)
+
+    def chats(self, rooms):
+        '''
+        returns the {room: chat id} of the rooms, creates the missing chats
+        '''
+        chats = dict(db.session.query(Chat.name, Chat.id)\
+                               .filter(Chat.name.in_(rooms)).all())
+        missing = [room for room in rooms if room not in chats]
+
+        for room in missing:
+            chat = Chat(name=room, gop_id=int(room.replace('gop', '')))
+            db.session.add(chat)
+            db.session.flush()
+            chats[room] = chat.id
+
+        return chats
+
+    def flush(self):
+        '''
+        saves the buffered messages, returns the number of the taken ones
+        '''
+        keys = [key for key in redis_store.smembers(CHAT_BUFFERS) \
+                if parse_buffer_key(key)]
+
+        # {key: (room, taken messages)}
+        taken = {}
+
+        for key in keys:
+            room, user_id = parse_buffer_key(key)
+            messages = self.take(key)
+
+            if messages:
+                taken[key] = (room, messages)
+            else:
+                self.unregister_if_empty(key)
+
+        if not taken:
+            return 0
+
+        try:
+            chats = self.chats(set(room for room, _ in taken.values()))
+            rows = []
+
+            for key, (room, messages) in taken.items():
+                for message_json in messages:
+                    try:
+                        message = load_message(message_json)
+                    except (ValueError, KeyError, TypeError):
+                        current_app.logger.error(
+                            'Invalid buffered chat message: %r', message_json)
+                        continue
+
+                    rows.append({
+                        'chat_id': chats[room],
+                        'text': message['message'],
+                        'user_id': message['user_id'],
+                        'datetime': message['datetime']
+                    })
+
+            if rows:
+                db.session.execute(ChatMessage.__table__.insert(), rows)
+
+            db.session.commit()
+        except Exception:
+            # the messages are still in their lists for the next run
+            db.session.rollback()
+            raise
+
+        self.remove_committed(taken)
+
+        return sum(len(messages) for _, messages in taken.values())
+
+    def run(self):
+        with self.app.app_context():
+            self.register_existing_buffers()
+
+            while True:
+                try:
+                    # flush on the timer or as soon as a list is large
+                    if redis_store.blpop(CHAT_FLUSH_SIGNAL,
+                                         self.config['CHAT_FLUSH_INTERVAL']):
+                        redis_store.delete(CHAT_FLUSH_SIGNAL)
+
+                    # the lists larger than the batch size take a few runs
+                    while self.flush():
+                        pass
+                except Exception:
+                    current_app.logger.exception('The chat flusher failed')
+                    time.sleep(self.config['CHAT_FLUSH_INTERVAL'])
+                finally:
+                    db.session.remove()
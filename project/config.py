@@ -10,11 +10,82 @@ class Config:
     # REDIS_URL = "redis://:password@localhost:6379/0"
     REDIS_URL = "redis://localhost:6379/0"
 
+    # the Socket.IO emits are passed between the workers and the hosts
+    # through the Redis of REDIS_URL, so the app can run in several
+    # processes and the background workers can emit to the rooms
+    SOCKETIO_MESSAGE_QUEUE = True
+
     SQLALCHEMY_COMMIT_ON_TEARDOWN = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_MIGRATE_REPO = os.path.join(basedir, 'db_repository')
     SQLALCHEMY_TRACK_MODIFICATIONS = True
 
+    # default and maximum page sizes of the API lists
+    API_PAGE_SIZE = 100
+    API_MAX_PAGE_SIZE = 1000
+    # rows read from the database at once by the NDJSON export
+    API_STREAM_CHUNK_SIZE = 500
+
+    # API keys cache, the TTLs are in seconds
+    API_KEY_CACHE_SIZE = 1024
+    API_KEY_CACHE_TTL = 300
+    API_KEY_REDIS_TTL = 3600
+
+    # GOP search index settings
+    SEARCH_PREFIX_MAX_LENGTH = 20
+    SEARCH_RESULTS_LIMIT = 100
+    # the number of the latest claims searched by substring
+    SEARCH_SCAN_LIMIT = 10000
+
+    # how often the ICD codes index checks for changes, in seconds
+    ICD_CODES_INDEX_CHECK_INTERVAL = 30
+    ICD_CODES_AUTOCOMPLETE_LIMIT = 10
+    ICD_CODES_AUTOCOMPLETE_MAX_LIMIT = 50
+    ICD_CODES_SEARCH_LIMIT = 500
+
+    # how long the dashboard counts are cached, in seconds
+    DASHBOARD_STATS_TTL = 60
+
+    # find the repeated queries of each request and Socket.IO event,
+    # add the debug headers and aggregate them in Redis for the
+    # /admin/perf page, enabled in the development and testing configs.
+    # The queries are always counted for /metrics
+    DB_INSTRUMENTATION = False
+    DB_INSTRUMENTATION_AGGREGATE = False
+    # when set, /metrics requires it as the bearer token, without it
+    # /metrics is served only by the development and testing configs
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    METRICS_PUBLIC = False
+    # when set to 1, the emails are sent by the background worker:
+    # manage.py mail_worker, which must be running
+    MAIL_QUEUE_ENABLED = os.environ.get('MAIL_QUEUE_ENABLED') == '1'
+    MAIL_QUEUE_BATCH_SIZE = 50
+    MAIL_QUEUE_MAX_ATTEMPTS = 5
+    # the failed emails are kept for a week, up to the limit
+    MAIL_QUEUE_FAILED_LIMIT = 1000
+    MAIL_QUEUE_FAILED_TTL = 7 * 86400
+    MAIL_QUEUE_RETRY_DELAY = 30
+    MAIL_QUEUE_POLL_TIMEOUT = 5
+    MAIL_QUEUE_IDLE_TIMEOUT = 10
+    # the number of the chat messages sent on joining a room
+    # and with every older page of the history
+    CHAT_HISTORY_PAGE_SIZE = 50
+    CHAT_HISTORY_MAX_PAGE_SIZE = 200
+    # the chat messages are saved by the background flusher:
+    # manage.py chat_flusher, every interval in seconds, or as soon as
+    # a user's list reaches the flush size
+    CHAT_FLUSH_INTERVAL = 2
+    CHAT_FLUSH_SIZE = 100
+    CHAT_FLUSH_BATCH_SIZE = 1000
+    # the notifications to the same user and room sent during
+    # the window, in seconds, are emitted as one digest
+    NOTIFICATIONS_COALESCE_WINDOW = 3
+    # the users' inboxes keep the latest notifications of the retention
+    NOTIFICATIONS_INBOX_LIMIT = 100
+    NOTIFICATIONS_RETENTION_DAYS = 30
+    NOTIFICATIONS_PAGE_SIZE = 20
+    NOTIFICATIONS_MAX_PAGE_SIZE = 100
+
     UPLOAD_FOLDER = os.path.join(basedir, 'static/uploads')
     ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif', 'csv'])
 
@@ -31,9 +102,17 @@ class Config:
 
 class DevelopmentConfig(Config):
     DEBUG = True
+    DB_INSTRUMENTATION = True
+    DB_INSTRUMENTATION_AGGREGATE = True
+    METRICS_PUBLIC = True
 
 class TestingConfig(Config):
     TESTING = True
+    DB_INSTRUMENTATION = True
+    DB_INSTRUMENTATION_AGGREGATE = True
+    METRICS_PUBLIC = True
+    # the Socket.IO test client receives only the emits of its process
+    SOCKETIO_MESSAGE_QUEUE = False
 
 class ProductionConfig(Config):
     try:
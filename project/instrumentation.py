@@ -0,0 +1,260 @@
+'''
+request-scoped instrumentation of the database queries
+
+every Flask request and Socket.IO event counts its queries and the time
+spent in the database for /metrics. With DB_INSTRUMENTATION it also
+counts the statements executed more than once, which usually are N+1
+queries, the figures are added to the response headers in debug and
+aggregated by endpoint in Redis for the /admin/perf page
+'''
+import time
+
+from functools import wraps
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from . import metrics, redis_store
+from .main.helpers import to_str
+
+
+# the Redis keys of the aggregated figures
+PERF_PREFIX = 'perf:'
+PERF_ENDPOINTS = PERF_PREFIX + 'endpoints'
+
+# the length the stored statements are cut to
+STATEMENT_MAX_LENGTH = 500
+
+# the number of the most repeated statements kept for each endpoint
+REPEATED_STATEMENTS_LIMIT = 20
+
+
+class QueryStats(object):
+    '''
+    the queries of a single request or Socket.IO event
+    '''
+    def __init__(self, name, track_statements=False):
+        self.name = name
+        self.count = 0
+        self.time = 0.0
+        self.track_statements = track_statements
+
+        # {statement: executions count}
+        self.statements = {}
+
+    def record(self, statement, elapsed):
+        self.count += 1
+        self.time += elapsed
+
+        if self.track_statements:
+            self.statements[statement] = \
+                self.statements.get(statement, 0) + 1
+
+    def repeated(self):
+        '''
+        returns the statements executed more than once
+        '''
+        return dict((statement, count) for statement, count \
+                    in self.statements.items() if count > 1)
+
+    def repeated_count(self):
+        '''
+        returns the number of the repeated executions
+        '''
+        return sum(count - 1 for count in self.repeated().values())
+
+    def headers(self):
+        return {
+            'X-DB-Query-Count': str(self.count),
+            'X-DB-Time-Ms': '%.2f' % (self.time * 1000),
+            'X-DB-Repeated-Queries': str(self.repeated_count())
+        }
+
+
+def start(name):
+    g.query_stats = QueryStats(
+        name, track_statements=current_app.config['DB_INSTRUMENTATION'])
+    return g.query_stats
+
+
+def current_stats():
+    '''
+    returns the stats of the current request or None outside of it
+    '''
+    if not has_app_context():
+        return None
+
+    return getattr(g, 'query_stats', None)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('query_start_time', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    started = conn.info['query_start_time'].pop()
+    stats = current_stats()
+
+    if stats is not None:
+        stats.record(statement, time.time() - started)
+
+
+def endpoint_key(name):
+    return PERF_PREFIX + 'endpoint:' + name
+
+
+def repeated_key(name):
+    return PERF_PREFIX + 'repeated:' + name
+
+
+def aggregate(stats):
+    '''
+    adds the stats of the finished request to its endpoint's figures
+    '''
+    repeated = stats.repeated()
+
+    try:
+        pipe = redis_store.pipeline()
+        pipe.sadd(PERF_ENDPOINTS, stats.name)
+        pipe.hincrby(endpoint_key(stats.name), 'requests', 1)
+        pipe.hincrby(endpoint_key(stats.name), 'queries', stats.count)
+        pipe.hincrbyfloat(endpoint_key(stats.name), 'db_time', stats.time)
+
+        if repeated:
+            pipe.hincrby(endpoint_key(stats.name), 'repeated_requests', 1)
+
+        for statement, count in repeated.items():
+            pipe.zincrby(repeated_key(stats.name),
+                         statement[:STATEMENT_MAX_LENGTH], count - 1)
+
+        if repeated:
+            # keep only the most repeated statements
+            pipe.zremrangebyrank(repeated_key(stats.name), 0,
+                                 -REPEATED_STATEMENTS_LIMIT - 1)
+
+        pipe.execute()
+    except:
+        pass
+
+
+def finish():
+    '''
+    records the stats of the current request in the metrics
+    and aggregates them, if enabled, returns them
+    '''
+    stats = current_stats()
+
+    if stats is None:
+        return None
+
+    g.query_stats = None
+
+    metrics.observe_queries(stats.name, stats.count, stats.time)
+
+    if current_app.config['DB_INSTRUMENTATION'] and \
+            current_app.config['DB_INSTRUMENTATION_AGGREGATE']:
+        aggregate(stats)
+
+    return stats
+
+
+def instrumented_event(name):
+    '''
+    the decorator of the Socket.IO event handlers,
+    the event's queries are counted like a request's
+    '''
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            metrics.count_event(name)
+
+            start('socketio:' + name)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                finish()
+        return wrapper
+    return decorator
+
+
+def endpoints_stats():
+    '''
+    returns the aggregated figures of all the endpoints,
+    the endpoints with the most queries per request go first
+    '''
+    endpoints = []
+
+    try:
+        names = sorted(redis_store.smembers(PERF_ENDPOINTS))
+    except:
+        return endpoints
+
+    for name in names:
+        name = to_str(name)
+
+        try:
+            figures = redis_store.hgetall(endpoint_key(name))
+            repeated = redis_store.zrevrange(repeated_key(name), 0, 4,
+                                             withscores=True)
+        except:
+            continue
+
+        figures = dict((to_str(k), float(v)) for k, v in figures.items())
+        requests = figures.get('requests', 0) or 1
+
+        endpoints.append({
+            'name': name,
+            'requests': int(figures.get('requests', 0)),
+            'queries': int(figures.get('queries', 0)),
+            'queries_per_request': figures.get('queries', 0) / requests,
+            'db_time_per_request': figures.get('db_time', 0) / requests * 1000,
+            'repeated_requests': int(figures.get('repeated_requests', 0)),
+            'repeated': [(to_str(s), int(c)) for s, c in repeated]
+        })
+
+    endpoints.sort(key=lambda e: e['queries_per_request'], reverse=True)
+
+    return endpoints
+
+
+def reset():
+    '''
+    deletes the aggregated figures
+    '''
+    try:
+        names = redis_store.smembers(PERF_ENDPOINTS)
+        keys = [PERF_ENDPOINTS]
+
+        for name in names:
+            name = to_str(name)
+            keys.extend([endpoint_key(name), repeated_key(name)])
+
+        redis_store.delete(*keys)
+    except:
+        pass
+
+
+def init_app(app):
+    '''
+    registers the request hooks of the instrumentation
+    '''
+    @app.before_request
+    def start_query_stats():
+        if request.endpoint != 'static':
+            # the paths of the unmatched urls would make unbounded keys
+            start(request.endpoint or 'unknown')
+
+    @app.after_request
+    def finish_query_stats(response):
+        stats = finish()
+
+        if stats is not None and app.debug and \
+                app.config['DB_INSTRUMENTATION']:
+            response.headers.extend(stats.headers())
+
+        return response
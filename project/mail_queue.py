@@ -0,0 +1,261 @@
+'''
+the queue of the emails, which are sent by a background worker
+
+the requests push the rendered messages to a Redis list and return at
+once, the worker (python manage.py mail_worker) sends them in batches
+over a single SMTP connection and retries the failed ones
+'''
+import json
+import smtplib
+import socket
+import time
+
+from flask import current_app
+from flask_mail import Message
+
+from . import mail, metrics, redis_store
+from .main.helpers import to_str
+
+
+MAIL_QUEUE = 'mail:queue'
+
+# the messages taken by the worker, they are requeued if it crashes
+MAIL_PROCESSING = 'mail:processing'
+
+# {message: the time to retry it}
+MAIL_RETRY = 'mail:retry'
+
+# the messages, which couldn't be sent after all the attempts,
+# the bodies of the sensitive ones are dropped
+MAIL_FAILED = 'mail:failed'
+
+MESSAGE_FIELDS = ['subject', 'recipients', 'body', 'html', 'sender',
+                  'cc', 'bcc', 'reply_to']
+
+# the errors after which the SMTP connection is opened again
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, socket.error)
+
+
+def dump_message(message, attempts=0, sensitive=False, redact=False):
+    '''
+    the redacted messages have no body, so the sensitive ones,
+    like the ones with the passwords, aren't kept after they fail
+    '''
+    data = dict((field, getattr(message, field)) for field in MESSAGE_FIELDS)
+    data['attempts'] = attempts
+    data['sensitive'] = sensitive
+
+    if redact and sensitive:
+        data['body'] = data['html'] = None
+
+    return json.dumps(data)
+
+
+def load_message(payload):
+    '''
+    returns the message, the number of the attempts made
+    and whether the message is sensitive
+    '''
+    data = json.loads(to_str(payload))
+    attempts = data.pop('attempts', 0)
+    sensitive = data.pop('sensitive', False)
+
+    return (Message(**data), attempts, sensitive)
+
+
+def enqueue(message, sensitive=False):
+    '''
+    pushes the message to the queue, the message is sent at once,
+    if the queue is disabled or Redis isn't available. The messages
+    with the credentials should be sensitive
+    '''
+    if current_app.config['MAIL_QUEUE_ENABLED']:
+        try:
+            redis_store.lpush(MAIL_QUEUE, dump_message(message,
+                                                       sensitive=sensitive))
+            return
+        except:
+            pass
+
+    try:
+        mail.send(message)
+    except Exception:
+        current_app.logger.exception('The email "%s" to %s is not sent',
+                                     message.subject,
+                                     ', '.join(message.send_to))
+
+
+class MailWorker(object):
+    '''
+    sends the queued messages, one worker is run for the app
+    '''
+    def __init__(self, app):
+        self.app = app
+        self.config = app.config
+
+    def requeue_processing(self):
+        '''
+        returns the messages of a crashed worker to the queue
+        '''
+        while redis_store.rpoplpush(MAIL_PROCESSING, MAIL_QUEUE):
+            pass
+
+    def requeue_due_retries(self):
+        '''
+        moves the messages, whose retry time has come, to the queue
+        '''
+        now = time.time()
+        due = redis_store.zrangebyscore(MAIL_RETRY, 0, now)
+
+        if due:
+            pipe = redis_store.pipeline()
+            pipe.zremrangebyscore(MAIL_RETRY, 0, now)
+            pipe.lpush(MAIL_QUEUE, *due)
+            pipe.execute()
+
+    def take_batch(self, timeout):
+        '''
+        takes up to the batch size of the messages,
+        waits for the first of them up to the timeout
+        '''
+        payload = redis_store.brpoplpush(MAIL_QUEUE, MAIL_PROCESSING,
+                                         timeout)
+        if not payload:
+            return []
+
+        batch = [payload]
+
+        while len(batch) < self.config['MAIL_QUEUE_BATCH_SIZE']:
+            payload = redis_store.rpoplpush(MAIL_QUEUE, MAIL_PROCESSING)
+
+            if not payload:
+                break
+
+            batch.append(payload)
+
+        return batch
+
+    def push_failed(self, pipe, payload):
+        '''
+        keeps the latest failed messages for the limited time
+        '''
+        pipe.lpush(MAIL_FAILED, payload)
+        pipe.ltrim(MAIL_FAILED, 0, self.config['MAIL_QUEUE_FAILED_LIMIT'] - 1)
+        pipe.expire(MAIL_FAILED, self.config['MAIL_QUEUE_FAILED_TTL'])
+
+    def failed(self, payload, message, attempts, sensitive):
+        '''
+        schedules the message to be retried with a growing delay,
+        or moves it to the failed ones after the last attempt
+        '''
+        attempts += 1
+        pipe = redis_store.pipeline()
+        pipe.lrem(MAIL_PROCESSING, 1, payload)
+
+        if attempts < self.config['MAIL_QUEUE_MAX_ATTEMPTS']:
+            delay = self.config['MAIL_QUEUE_RETRY_DELAY'] * 2 ** (attempts - 1)
+            pipe.zadd(MAIL_RETRY, time.time() + delay,
+                      dump_message(message, attempts, sensitive))
+        else:
+            self.push_failed(pipe, dump_message(message, attempts, sensitive,
+                                                redact=True))
+            current_app.logger.error('The email "%s" to %s is not sent '
+                                     'after %d attempts', message.subject,
+                                     ', '.join(message.send_to), attempts)
+
+        pipe.execute()
+
+    def return_to_queue(self, batch):
+        '''
+        returns the taken messages to the head of the queue
+        '''
+        pipe = redis_store.pipeline()
+
+        for payload in batch:
+            pipe.lrem(MAIL_PROCESSING, 1, payload)
+            pipe.rpush(MAIL_QUEUE, payload)
+
+        pipe.execute()
+
+    def send_batch(self, connection, batch):
+        '''
+        sends the batch over the open connection, returns False
+        if the connection is broken and has to be opened again
+        '''
+        for i, payload in enumerate(batch):
+            try:
+                message, attempts, sensitive = load_message(payload)
+            except (ValueError, TypeError):
+                current_app.logger.error('Invalid queued email')
+                pipe = redis_store.pipeline()
+                pipe.lrem(MAIL_PROCESSING, 1, payload)
+                self.push_failed(pipe, payload)
+                pipe.execute()
+                continue
+
+            started = time.time()
+
+            try:
+                connection.send(message)
+            except CONNECTION_ERRORS:
+                metrics.mail_duration.observe(['error'],
+                                              time.time() - started)
+                self.failed(payload, message, attempts, sensitive)
+                self.return_to_queue(batch[i + 1:])
+                return False
+            except Exception:
+                metrics.mail_duration.observe(['error'],
+                                              time.time() - started)
+                self.failed(payload, message, attempts, sensitive)
+                continue
+
+            metrics.mail_duration.observe(['sent'], time.time() - started)
+            redis_store.lrem(MAIL_PROCESSING, 1, payload)
+
+        return True
+
+    def work_connected(self):
+        '''
+        keeps the SMTP connection open while there are messages
+        in the queue, closes it after the idle timeout
+        '''
+        batch = self.take_batch(self.config['MAIL_QUEUE_POLL_TIMEOUT'])
+
+        if not batch:
+            return
+
+        connection = mail.connect()
+
+        try:
+            connection.__enter__()
+        except Exception:
+            current_app.logger.exception('Could not connect to the mail server')
+            self.return_to_queue(batch)
+            time.sleep(self.config['MAIL_QUEUE_RETRY_DELAY'])
+            return
+
+        try:
+            while batch:
+                if not self.send_batch(connection, batch):
+                    break
+
+                self.requeue_due_retries()
+                batch = self.take_batch(
+                    self.config['MAIL_QUEUE_IDLE_TIMEOUT'])
+        finally:
+            try:
+                connection.__exit__(None, None, None)
+            except Exception:
+                pass
+
+    def run(self):
+        with self.app.app_context():
+            self.requeue_processing()
+
+            while True:
+                try:
+                    self.requeue_due_retries()
+                    self.work_connected()
+                except Exception:
+                    current_app.logger.exception('The mail worker failed')
+                    time.sleep(self.config['MAIL_QUEUE_POLL_TIMEOUT'])
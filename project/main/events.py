@@ -1,4 +1,3 @@
-import dateutil.parser
 import json
 
 from datetime import datetime
@@ -6,9 +5,14 @@ from flask import request, session, url_for
 from flask_login import current_user
 from flask_socketio import send, emit, join_room, leave_room
 
-from .. import db, redis_store, socketio
-from ..models import Chat, ChatMessage
-from .helpers import notify, to_str
+from .. import db, socketio
+from ..chat_flusher import buffer_message, buffered_messages, merge_history
+from ..instrumentation import instrumented_event
+from ..models import Chat
+from ..notifications import mark_read as mark_notifications_read
+from ..notifications import page as notifications_page
+from ..notifications import unread as unread_notifications
+from .helpers import notify
 from .services import ChatService
 
 
@@ -23,6 +27,7 @@ def date_handler(obj):
         raise TypeError
 
 @socketio.on('hello')
+@instrumented_event('hello')
 def handle_hello(message):
     '''
     joins authenticates users to chat room
@@ -36,20 +41,66 @@ def handle_hello(message):
 
 
 @socketio.on('check-notifications')
+@instrumented_event('check-notifications')
 def handle_notifications(data):
     '''
-    checks for notification for a particular user
+    sends a page of the user's notifications with their read state,
+    the older pages are requested with the 'before' cursor
     '''
-    # try connecting to redis server
-    try:
-        notification = redis_store.get('id' + str(data))
-    except:
-        notification = None
+    if not current_user.is_authenticated:
+        return
+
+    before, limit = None, None
+
+    if isinstance(data, dict):
+        before = data.get('before')
+
+        try:
+            limit = int(data.get('limit') or 0)
+        except (TypeError, ValueError):
+            pass
+
+    notifications, before = notifications_page(current_user.id,
+                                               before=before, limit=limit)
+    emit('check-notifications', {'notifications': notifications,
+                                 'before': before})
+
+
+@socketio.on('pending-notifications')
+@instrumented_event('pending-notifications')
+def handle_pending_notifications(data):
+    '''
+    sends the user's unread notifications sent after the client's
+    'since' timestamp, the clients send it after reconnecting to get
+    the notifications they have missed
+    '''
+    if not current_user.is_authenticated:
+        return
 
-    if notification:
-        # return notification text and delete it from redis
-        emit('check-notifications', notification.decode('utf-8'))
-        redis_store.delete('id' + str(data))
+    since = data.get('since') if isinstance(data, dict) else None
+
+    emit('pending-notifications',
+         {'notifications': unread_notifications(current_user.id,
+                                                since=since)})
+
+
+@socketio.on('read-notifications')
+@instrumented_event('read-notifications')
+def handle_read_notifications(data):
+    '''
+    marks the notifications with the ids, the ones of the room
+    or all of them as read
+    '''
+    if not current_user.is_authenticated:
+        return
+
+    ids, room_name = None, None
+
+    if isinstance(data, dict):
+        ids = data.get('ids')
+        room_name = data.get('room_name')
+
+    mark_notifications_read(current_user.id, ids, room_name=room_name)
 
 
 @socketio.on_error_default
@@ -61,6 +112,7 @@ def default_error_handler(e):
 
 
 @socketio.on('joined', namespace='/chat')
+@instrumented_event('chat:joined')
 def joined(message):
     '''Sent by clients when they enter a room.
     A status message is broadcast to all people in the room.'''
@@ -73,31 +125,47 @@ def joined(message):
        db.session.add(chat)
        db.session.commit(chat)
 
-    try:
-        chat_service.save_from_redis(chat)
-    except:
-        pass
-
-    chat_messages = ChatMessage.query.order_by(ChatMessage.datetime)\
-                                     .filter_by(chat_id=chat.id).all()
-
-    chat_messages_list = []
-    for chat_message in chat_messages:
-        chat_messages_list.append({
-            'name': chat_message.user.email,
-            'msg': chat_message.text,
-            'datetime': chat_message.datetime.strftime('%I:%M:%S %p %d/%m/%Y')
-        })
+    # only the last page of the history is sent and only to the client,
+    # which has joined, the older pages are requested with 'history'.
+    # The messages not saved by the chat flusher yet are added from Redis,
+    # they are read first, so the ones saved in the meantime are in the
+    # database's page and aren't missed
+    buffered = buffered_messages(room)
+    messages, before = chat_service.history(chat)
+    messages = merge_history(messages, buffered)
+    emit('history', {'messages': messages, 'before': before})
 
     emit('status',
          {'name': session.get('name'),
           'msg': '<span style="color: green;">has entered the room.</span>',
           'datetime': datetime.now().strftime('%I:%M:%S %p %d/%m/%Y'),
-         'messages': chat_messages_list},
+         'messages': []},
          room=room)
 
 
+@socketio.on('history', namespace='/chat')
+@instrumented_event('chat:history')
+def history(message):
+    '''Sent by clients to load the messages older than the 'before'
+    cursor, which they received with the previous page.'''
+    chat = Chat.query.filter_by(name=session.get('room')).first()
+
+    if not chat or not message.get('before'):
+        emit('history', {'messages': [], 'before': None})
+        return
+
+    try:
+        limit = int(message.get('limit') or 0)
+    except (TypeError, ValueError):
+        limit = 0
+
+    messages, before = chat_service.history(chat, before=message['before'],
+                                            limit=limit)
+    emit('history', {'messages': messages, 'before': before})
+
+
 @socketio.on('text', namespace='/chat')
+@instrumented_event('chat:text')
 def text(message):
     '''Sent by a client when the user entered a new message.
     The message is sent to all people in the room.'''
@@ -123,21 +191,18 @@ def text(message):
            user_id=session.get('payer_user_id'),
            room_name=room)
 
-    # Push the message into Redis
-    # try:
+    # the message is saved to the database by the chat flusher
     msg_dict = {'message': message['msg'],
                 'user_id': current_user.id,
                 'datetime': date_time}
     msg_json = json.dumps(msg_dict, default=date_handler)
 
-    user_msg_list = '%suser%d' % (room, current_user.id)
-    redis_store.rpush(user_msg_list, msg_json)
-    # except:
-    #     pass # If saving to Redis failed, we should save it directly to MySQL
+    buffer_message(room, current_user.id, msg_json)
 
 
 @socketio.on('left', namespace='/chat')
 @socketio.on('disconnect', namespace='/chat')
+@instrumented_event('chat:left')
 def handle_chat_disconnect():
     '''Sent by clients when they leave a room.
     A status message is broadcast to all people in the room.'''
@@ -150,12 +215,3 @@ def handle_chat_disconnect():
          'messages': []},
          room=room)
 
-
-    chat = Chat.query.filter_by(name=room).first()
-    if not chat:
-       chat = Chat(name=room, gop_id=int(room.replace('gop', '')))
-       db.session.add(chat)
-       db.session.commit(chat)
-
-    chat_service.save_from_redis(chat)
-
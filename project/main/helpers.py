@@ -11,7 +11,7 @@ from flask import request, session, url_for, make_response
 from flask_login import current_user
 from werkzeug.utils import secure_filename
 
-from .. import config, redis_store, socketio
+from .. import config, socketio
 
 
 def prepare_gop_dict(gop):
@@ -68,7 +68,8 @@ def prepare_gop_dict(gop):
 
 def prepare_gops_list(gops):
     '''The function takes the GOP model objects list and convert it to the
-    python dictionary'''
+    python dictionary. Load the GOPs with GuaranteeOfPaymentService.eager_load()
+    first, otherwise each GOP lazy loads its relations'''
 
     if not gops:
         return []
@@ -164,26 +165,36 @@ def validate_email_address(data):
         return True
 
 
+def emit_to_room(event, data, room, namespace='/'):
+    '''
+    sends the socketio message to the room, works in any process
+    created with create_app: the emits go through the message queue
+    to the workers, which hold the room's connections
+    '''
+    try:
+        socketio.emit(event, data, room=room, namespace=namespace)
+    except:
+        pass
+
+
 def notify(title='New notification', message='Message',
            url=None, user=current_user, user_id=None,
            room_name=None):
     '''
-    function to send socketio message
+    function to send socketio message, the messages to the same
+    user and room are coalesced by the notifications dispatcher
     '''
+    from ..notifications import dispatch
+
     try:
         # if the user's id is not passed,
         # use the User object instead
         if not user_id:
             user_id = user.id
-
-        socketio.emit('message',
-                      {'title': title,
-                       'message': message,
-                       'url': url,
-                       'room_name': room_name},
-                      room=user_id)
     except:
-        pass
+        return
+
+    dispatch(user_id, title, message, url=url, room_name=room_name)
 
 
 def is_admin(user):
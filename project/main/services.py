@@ -1,16 +1,35 @@
 import dateutil.parser
 import json
+import re
+import time
 
-from flask import request, render_template, session
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+
+from flask import current_app, request, render_template, session
 from flask_login import current_user
 from flask_mail import Message
-from flask_servicelayer import SQLAlchemyService
-
-from .. import db, models, mail, redis_store
+from flask_servicelayer import Pagination, SQLAlchemyService
+from sqlalchemy import and_, cast, desc, event, inspect, or_, String
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, object_session, Session
+from sqlalchemy.orm import subqueryload
+from sqlalchemy.sql import func
+
+from .. import db, models, mail_queue, redis_store
 from ..models import Chat, ChatMessage, User
 from .helpers import is_admin, is_payer, is_provider, pass_generator, to_str
 
 
+def escape_like(value):
+    '''
+    escapes the LIKE wildcards of the user's input with the slash,
+    the backslash would need escaping in the MySQL string literals
+    '''
+    return value.replace('/', '//').replace('%', '/%').replace('_', '/_')
+
+
 class ExtFuncsMixin(object):
     '''
     base class for medipay operations
@@ -74,8 +93,7 @@ class ClaimService(ExtFuncsMixin, SQLAlchemyService):
             return self._find(provider_id=user.provider.id)
 
         elif is_payer(user):
-            claim_ids = [gop.claim.id for gop in user.payer.guarantees_of_payment if gop.claim]
-            return self.__model__.query.filter(self.__model__.id.in_(claim_ids))
+            return self.for_payer(user.payer)
 
         elif is_admin(user):
             return self.all_for_admin()
@@ -90,15 +108,93 @@ class ClaimService(ExtFuncsMixin, SQLAlchemyService):
             return user.provider.claims.filter_by(id=id).first()
 
         elif is_payer(user):
-            claim_ids = [gop.claim.id for gop in user.payer.guarantees_of_payment]
-            return self.__model__.query.filter(self.__model__.id==id and \
-                                        self.__model__.id.in_(claim_ids)).first()
+            return self.for_payer(user.payer)\
+                       .filter(self.__model__.id == id).first()
 
         elif is_admin(user):
             return self.get_for_admin(id)
 
         return None
 
+    def for_payer(self, payer):
+        '''
+        returns the query of the claims of the payer's GOP requests,
+        the claims are joined with their GOP requests in SQL
+        '''
+        model = self.__model__
+        gop = models.GuaranteeOfPayment
+
+        return model.query.join(gop, model.gop_id == gop.id)\
+                          .filter(gop.payer_id == payer.id)
+
+    def providers_for_payer(self, payer):
+        '''
+        returns the query of the providers of the payer's claims
+        '''
+        provider_ids = self.for_payer(payer)\
+            .with_entities(self.__model__.provider_id)
+
+        return models.Provider.query\
+            .filter(models.Provider.id.in_(provider_ids.statement))
+
+    def search(self, query, user):
+        '''
+        returns the ids of the user's claims matching the query. The
+        claims whose numbers start with the query go first, they are
+        found with the claim_number index. The rest of the fields are
+        matched by substring only among the user's latest claims, so
+        the scan takes a bounded time
+        '''
+        claims = self.all_for_user(user)
+
+        if claims is None:
+            return []
+
+        model = self.__model__
+        limit = current_app.config['SEARCH_RESULTS_LIMIT']
+        escaped = escape_like(query)
+
+        prefix_ids = [claim_id for claim_id, in claims.with_entities(model.id)\
+            .filter(model.claim_number.like(escaped + '%', escape='/'))\
+            .order_by(model.claim_number)\
+            .limit(limit)]
+
+        if len(prefix_ids) >= limit:
+            return prefix_ids
+
+        search = '%' + escaped + '%'
+
+        # the id of the oldest claim the substring search goes through
+        oldest_id = claims.with_entities(model.id)\
+            .order_by(desc(model.id))\
+            .offset(current_app.config['SEARCH_SCAN_LIMIT'] - 1)\
+            .limit(1).scalar()
+
+        found = claims.with_entities(model.id)\
+            .outerjoin(models.Terminal,
+                       model.terminal_id == models.Terminal.id)\
+            .filter(or_(model.claim_number.like(search, escape='/'),
+                        model.status.ilike(search, escape='/'),
+                        model.claim_type.ilike(search, escape='/'),
+                        cast(model.datetime, String).like(search,
+                                                          escape='/'),
+                        model.admitted.like(search, escape='/'),
+                        model.discharged.like(search, escape='/'),
+                        model.amount.like(search, escape='/'),
+                        models.Terminal.location.ilike(search,
+                                                       escape='/')))
+
+        if oldest_id is not None:
+            found = found.filter(model.id >= oldest_id)
+
+        if prefix_ids:
+            found = found.filter(~model.id.in_(prefix_ids))
+
+        found = found.order_by(desc(model.id))\
+                     .limit(limit - len(prefix_ids))
+
+        return prefix_ids + [claim_id for claim_id, in found]
+
 
 class GuaranteeOfPaymentService(ExtFuncsMixin, SQLAlchemyService):
     '''
@@ -113,6 +209,20 @@ class GuaranteeOfPaymentService(ExtFuncsMixin, SQLAlchemyService):
         '''
         return self.__model__.query.filter_by(closed=False)
 
+    def eager_load(self, query=None):
+        '''
+        loads the GOPs together with their provider, payer, member and
+        ICD codes in a fixed number of queries, so the GOPs list can be
+        serialized without lazy loading the relations for every row
+        '''
+        if query is None:
+            query = self.__model__.query
+
+        return query.options(joinedload(self.__model__.provider),
+                             joinedload(self.__model__.payer),
+                             joinedload(self.__model__.member),
+                             subqueryload(self.__model__.icd_codes))
+
     def filter_for_user(self, query, user):
         '''
         obtain all GOP requests for a particular user
@@ -156,11 +266,9 @@ class GuaranteeOfPaymentService(ExtFuncsMixin, SQLAlchemyService):
                                    root=request.url_root, user=user,
                                    rand_pass=rand_pass)
 
-        # send the email
-        try:
-            mail.send(msg)
-        except:
-            pass
+        # the email is sent by the mail worker,
+        # it has the new user's password
+        mail_queue.enqueue(msg, sensitive=rand_pass is not None)
 
     def set_chat_room(self, gop):
         '''
@@ -204,6 +312,20 @@ class ICDCodeService(ExtFuncsMixin, SQLAlchemyService):
     __model__ = models.ICDCode
     __db__ = db
 
+    def search(self, query, page=1, per_page=10):
+        '''
+        returns a page of the ICD codes matching the query
+        and the page's pagination object
+        '''
+        icd_codes = icd_code_index.search(
+            query, limit=current_app.config['ICD_CODES_SEARCH_LIMIT'])
+
+        start = (page - 1) * per_page
+        pagination = Pagination(page, per_page, len(icd_codes),
+                                icd_codes[start:start + per_page])
+
+        return (pagination, pagination.items)
+
 
 class MemberService(ExtFuncsMixin, SQLAlchemyService):
     '''
@@ -220,9 +342,7 @@ class MemberService(ExtFuncsMixin, SQLAlchemyService):
             return user.provider.members
 
         elif is_payer(user):
-            claim_ids = [gop.claim.id for gop in user.payer.guarantees_of_payment]
-            return self.__model__.query.join(models.Claim, self.__model__.claims)\
-                                       .filter(models.Claim.id.in_(claim_ids))
+            return self.for_payer(user.payer)
 
         elif is_admin(user):
             return self.all_for_admin()
@@ -237,16 +357,25 @@ class MemberService(ExtFuncsMixin, SQLAlchemyService):
             return user.provider.members.filter_by(id=id).first()
 
         elif is_payer(user):
-            claim_ids = [gop.claim.id for gop in user.payer.guarantees_of_payment]
-            return self.__model__.query.join(models.Claim, self.__model__.claims)\
-                                       .filter(models.Claim.id.in_(claim_ids))\
-                                       .filter(self.__model__.id==id).first()
+            return self.for_payer(user.payer)\
+                       .filter(self.__model__.id == id).first()
 
         elif is_admin(user):
             return self.get_for_admin(id)
 
         return None
 
+    def for_payer(self, payer):
+        '''
+        returns the query of the members who have claims of the payer's
+        GOP requests, each member is returned once
+        '''
+        member_ids = ClaimService().for_payer(payer)\
+            .with_entities(models.Claim.member_id)
+
+        return self.__model__.query\
+            .filter(self.__model__.id.in_(member_ids.statement))
+
 
 class TerminalService(ExtFuncsMixin, SQLAlchemyService):
     '''
@@ -287,26 +416,1072 @@ class ChatService(ExtFuncsMixin, SQLAlchemyService):
     __model__ = models.Chat
     __db__ = db
 
-    def save_for_user(self, chat, user_id):
-        '''function saves each user's history to MySQL'''
-        user_msg_list = '%suser%d' % (chat.name, user_id)
-        msg_list = redis_store.lrange(user_msg_list, 0, -1)
-
-        if msg_list:
-            for msg_json in msg_list:
-                msg_dict = json.loads(to_str(msg_json))
-                msg_dict['datetime'] = dateutil.parser.parse(msg_dict['datetime'])
-
-                chat_message = ChatMessage(chat=chat,
-                                           text=msg_dict['message'],
-                                           user_id=msg_dict['user_id'],
-                                           datetime=msg_dict['datetime'])
-                db.session.add(chat_message)
-
-            db.session.commit()
-            redis_store.delete(user_msg_list)
-
-    def save_from_redis(self, chat):
-        '''function saves each user's history to Redis'''
-        self.save_for_user(chat, chat.guarantee_of_payment.provider.user.id)
-        self.save_for_user(chat, chat.guarantee_of_payment.payer.user.id)
+    @staticmethod
+    def history_cursor(chat_message):
+        '''
+        returns the cursor of the messages older than the given one
+        '''
+        return '%s,%d' % (chat_message.datetime.isoformat(), chat_message.id)
+
+    @staticmethod
+    def parse_history_cursor(cursor):
+        '''
+        returns the (datetime, id) of the cursor or None if it's invalid
+        '''
+        try:
+            date_time, message_id = cursor.rsplit(',', 1)
+            return (dateutil.parser.parse(date_time), int(message_id))
+        except (AttributeError, ValueError, OverflowError):
+            return None
+
+    def history(self, chat, before=None, limit=None):
+        '''
+        returns a page of the chat's messages, from the oldest to the
+        newest, and the cursor of the older page or None if it's the
+        first one. The authors' emails are fetched in the same query
+        '''
+        max_limit = current_app.config['CHAT_HISTORY_MAX_PAGE_SIZE']
+        limit = limit or current_app.config['CHAT_HISTORY_PAGE_SIZE']
+        limit = max(1, min(limit, max_limit))
+
+        query = db.session.query(ChatMessage.id, ChatMessage.text,
+                                 ChatMessage.datetime, User.email)\
+                          .outerjoin(User, User.id == ChatMessage.user_id)\
+                          .filter(ChatMessage.chat_id == chat.id)
+
+        before = self.parse_history_cursor(before) if before else None
+
+        if before:
+            date_time, message_id = before
+            query = query.filter(or_(
+                ChatMessage.datetime < date_time,
+                and_(ChatMessage.datetime == date_time,
+                     ChatMessage.id < message_id)))
+
+        # one more message tells whether there is an older page
+        rows = query.order_by(desc(ChatMessage.datetime),
+                              desc(ChatMessage.id))\
+                    .limit(limit + 1).all()
+
+        cursor = self.history_cursor(rows[limit - 1]) \
+            if len(rows) > limit else None
+
+        messages = [{
+            'name': row.email,
+            'msg': row.text,
+            'datetime': row.datetime.strftime('%I:%M:%S %p %d/%m/%Y')
+        } for row in reversed(rows[:limit])]
+
+        return (messages, cursor)
+
+
+class GOPSearchService(object):
+    '''
+    inverted index of the GOP requests text fields kept in Redis.
+    Every prefix of every word is stored as a sorted set of GOP ids,
+    scored by the weight of the field the word was found in, so the
+    query words match the beginnings of the words, not their middles.
+    The entries are refreshed after the commits, which change the GOPs,
+    their members' or their payers' searchable fields
+    '''
+    prefix = 'search:gop:'
+
+    # the GOP's fields and their weights in the results ranking
+    fields = {
+        'member_name': 5,
+        'payer_company': 3,
+        'doctor_name': 3,
+        'patient_medical_no': 2,
+        'member_tel': 2,
+        'patient_action_plan': 1,
+        'room_type': 1,
+        'room_price': 1,
+        'doctor_fee': 1,
+        'surgery_fee': 1,
+        'medication_fee': 1,
+        'member_gender': 1
+    }
+
+    @staticmethod
+    def tokenize(text):
+        '''
+        splits the text into lower case words
+        '''
+        if text is None:
+            return []
+
+        return re.findall(r'[\w.]+', ('%s' % to_str(text)).lower(),
+                          flags=re.UNICODE)
+
+    def terms(self, word):
+        '''
+        returns all the prefixes of the word to search by
+        the beginning of a word
+        '''
+        max_length = current_app.config['SEARCH_PREFIX_MAX_LENGTH']
+        return [word[:i] for i in range(1, min(len(word), max_length) + 1)]
+
+    def gop_fields(self, gop):
+        '''
+        returns the searchable values of the GOP
+        '''
+        return {
+            'member_name': gop.member.name if gop.member else None,
+            'member_gender': gop.member.gender if gop.member else None,
+            'member_tel': gop.member.tel if gop.member else None,
+            'payer_company': gop.payer.company if gop.payer else None,
+            'doctor_name': gop.doctor_name,
+            'patient_medical_no': gop.patient_medical_no,
+            'patient_action_plan': gop.patient_action_plan,
+            'room_type': gop.room_type,
+            'room_price': gop.room_price,
+            'doctor_fee': gop.doctor_fee,
+            'surgery_fee': gop.surgery_fee,
+            'medication_fee': gop.medication_fee
+        }
+
+    def index(self, gop):
+        '''
+        adds the GOP to the index or refreshes its index entry,
+        the index is not critical, so Redis errors are ignored
+        '''
+        try:
+            self._index(gop)
+        except:
+            pass
+
+    def _index(self, gop):
+        scores = {}
+
+        for field, value in self.gop_fields(gop).items():
+            for word in self.tokenize(value):
+                for term in self.terms(word):
+                    scores[term] = scores.get(term, 0) + self.fields[field]
+
+        doc_key = '%sdoc:%d' % (self.prefix, gop.id)
+        old_terms = redis_store.smembers(doc_key)
+
+        pipe = redis_store.pipeline()
+
+        # remove the GOP from the terms it doesn't contain anymore
+        for term in old_terms:
+            term = to_str(term)
+            if term not in scores:
+                pipe.zrem(self.prefix + 'term:' + term, gop.id)
+
+        pipe.delete(doc_key)
+
+        for term, score in scores.items():
+            pipe.zadd(self.prefix + 'term:' + term, score, gop.id)
+            pipe.sadd(doc_key, term)
+
+        pipe.sadd('%sprovider:%s' % (self.prefix, gop.provider_id), gop.id)
+        pipe.sadd('%spayer:%s' % (self.prefix, gop.payer_id), gop.id)
+        pipe.execute()
+
+    def _remove(self, gop_id):
+        doc_key = '%sdoc:%d' % (self.prefix, gop_id)
+
+        pipe = redis_store.pipeline()
+
+        for term in redis_store.smembers(doc_key):
+            pipe.zrem(self.prefix + 'term:' + to_str(term), gop_id)
+
+        pipe.delete(doc_key)
+        pipe.execute()
+
+    def _remove_from_scope(self, gop_id, provider_id, payer_id):
+        pipe = redis_store.pipeline()
+        pipe.srem('%sprovider:%s' % (self.prefix, provider_id), gop_id)
+        pipe.srem('%spayer:%s' % (self.prefix, payer_id), gop_id)
+        pipe.execute()
+
+    def mark(self, session, gop_ids):
+        '''
+        stores the ids of the GOPs to reindex after the commit
+        '''
+        session.info.setdefault('gop_search_reindex', set()).update(gop_ids)
+
+    def mark_scope(self, session, gop_id, provider_id, payer_id):
+        '''
+        stores the provider and payer the GOP is moved from
+        '''
+        session.info.setdefault('gop_search_scopes', set()).add(
+            (gop_id, provider_id, payer_id))
+
+    def mark_removed(self, session, gop_id, provider_id, payer_id):
+        session.info.setdefault('gop_search_remove', set()).add(gop_id)
+        self.mark_scope(session, gop_id, provider_id, payer_id)
+
+    def apply(self, gop_ids, scopes, removed):
+        '''
+        refreshes the entries of the changed GOPs, the GOPs are read
+        with a separate session, as the committed one can't run queries
+        '''
+        for gop_id, provider_id, payer_id in scopes:
+            self._remove_from_scope(gop_id, provider_id, payer_id)
+
+        for gop_id in removed:
+            self._remove(gop_id)
+
+        gop_ids = gop_ids - removed
+
+        if not gop_ids:
+            return
+
+        session = Session(bind=db.engine)
+
+        try:
+            gops = session.query(models.GuaranteeOfPayment).options(
+                joinedload(models.GuaranteeOfPayment.member),
+                joinedload(models.GuaranteeOfPayment.payer))\
+                .filter(models.GuaranteeOfPayment.id.in_(gop_ids))
+
+            for gop in gops:
+                self._index(gop)
+        finally:
+            session.close()
+
+    def rebuild(self):
+        '''
+        indexes all the GOP requests
+        '''
+        gops = models.GuaranteeOfPayment.query.options(
+            joinedload(models.GuaranteeOfPayment.member),
+            joinedload(models.GuaranteeOfPayment.payer))
+
+        for gop in gops.yield_per(500):
+            self._index(gop)
+
+    def scope_key(self, user):
+        '''
+        returns the key of the GOP ids set the user can see,
+        None means no restriction
+        '''
+        if is_admin(user):
+            return None
+        elif is_provider(user):
+            return '%sprovider:%d' % (self.prefix, user.provider.id)
+        elif is_payer(user):
+            return '%spayer:%d' % (self.prefix, user.payer.id)
+
+        return False
+
+    def search(self, query, user):
+        '''
+        returns the ids of the user's GOPs matching all the words
+        of the query, best matches first
+        '''
+        scope_key = self.scope_key(user)
+
+        if scope_key is False:
+            return []
+
+        try:
+            return self._search(query, scope_key)
+        except:
+            # the index is not available, search the database instead
+            return self._search_sql(query, user)
+
+    def _search(self, query, scope_key):
+        max_length = current_app.config['SEARCH_PREFIX_MAX_LENGTH']
+        limit = current_app.config['SEARCH_RESULTS_LIMIT']
+
+        words = set(word[:max_length] for word in self.tokenize(query))
+
+        if not words:
+            return []
+
+        keys = dict((self.prefix + 'term:' + word, 1) for word in words)
+
+        if scope_key:
+            # the scope set doesn't change the score
+            keys[scope_key] = 0
+
+        result_key = '%sresult:%s' % (self.prefix, pass_generator(size=12))
+
+        pipe = redis_store.pipeline()
+        pipe.zinterstore(result_key, keys, aggregate='SUM')
+        pipe.zrevrange(result_key, 0, limit - 1)
+        pipe.delete(result_key)
+        ids = pipe.execute()[1]
+
+        return [int(gop_id) for gop_id in ids]
+
+    def _search_sql(self, query, user):
+        model = models.GuaranteeOfPayment
+        search = '%' + escape_like(query) + '%'
+
+        gops = db.session.query(model.id)\
+            .outerjoin(models.Member, model.member_id == models.Member.id)\
+            .outerjoin(models.Payer, model.payer_id == models.Payer.id)\
+            .filter(or_(
+                model.patient_action_plan.ilike(search, escape='/'),
+                model.doctor_name.ilike(search, escape='/'),
+                model.room_type.ilike(search, escape='/'),
+                models.Member.name.ilike(search, escape='/'),
+                models.Member.tel.ilike(search, escape='/'),
+                models.Payer.company.ilike(search, escape='/')))
+
+        if is_provider(user):
+            gops = gops.filter(model.provider_id == user.provider.id)
+        elif is_payer(user):
+            gops = gops.filter(model.payer_id == user.payer.id)
+
+        gops = gops.limit(current_app.config['SEARCH_RESULTS_LIMIT'])
+
+        return [gop_id for gop_id, in gops]
+
+
+gop_search_service = GOPSearchService()
+
+
+# the ICD code as it is stored in the ICD codes index
+ICDCodeEntry = namedtuple('ICDCodeEntry',
+                          ['id', 'code', 'edc', 'description', 'common_term'])
+
+
+def contains(positions, position):
+    '''
+    checks if the sorted array has the position
+    '''
+    i = bisect_left(positions, position)
+    return i < len(positions) and positions[i] == position
+
+
+class ICDCodeIndex(object):
+    '''
+    in-memory index of the ICD codes for the ICD code search and
+    autocomplete. The codes are loaded from the database once and
+    indexed by trigrams, a query is answered by intersecting the
+    trigrams of the query, so only a few codes are compared with it.
+    The queries shorter than a trigram match the beginnings of the
+    words. The postings are kept in compact arrays of positions.
+    When the ICD codes change, the version in Redis is increased and
+    every process reloads its index
+    '''
+    version_key = 'icd_codes:version'
+    fields = ['code', 'description', 'common_term']
+    gram_size = 3
+
+    def __init__(self):
+        self.entries = None
+        self.texts = []
+        # {trigram or word prefix: sorted array of the entries positions}
+        self.grams = {}
+        self.prefixes = {}
+        self.choices = []
+        self.version = None
+        self.checked_at = 0
+
+    def current_version(self):
+        '''
+        reads the ICD codes version from Redis
+        '''
+        try:
+            return to_str(redis_store.get(self.version_key))
+        except:
+            return self.version
+
+    def invalidate(self):
+        '''
+        makes all the processes reload their ICD codes index
+        '''
+        self.entries = None
+
+        try:
+            redis_store.incr(self.version_key)
+        except:
+            pass
+
+    def load(self):
+        '''
+        loads the ICD codes from the database and builds the index
+        '''
+        version = self.current_version()
+
+        entries = []
+        texts = []
+        grams = {}
+        prefixes = {}
+        choices = []
+
+        icd_codes = db.session.query(models.ICDCode.id,
+                                     models.ICDCode.code,
+                                     models.ICDCode.edc,
+                                     models.ICDCode.description,
+                                     models.ICDCode.common_term)\
+                              .order_by(models.ICDCode.code)
+
+        for row in icd_codes:
+            entry = ICDCodeEntry(row[0], *[value or '' for value in row[1:]])
+            position = len(entries)
+            entries.append(entry)
+
+            # the lower case text of the searchable fields
+            text = [getattr(entry, field).lower() for field in self.fields]
+            texts.append(text)
+
+            entry_grams = set()
+            entry_prefixes = set()
+
+            for field_text in text:
+                entry_grams.update(self.text_grams(field_text))
+
+                for word in field_text.split():
+                    for size in range(1, self.gram_size):
+                        entry_prefixes.add(word[:size])
+
+            # the positions are added in the ascending order,
+            # so every postings array is sorted
+            for gram in entry_grams:
+                grams.setdefault(gram, array('I')).append(position)
+
+            for prefix in entry_prefixes:
+                prefixes.setdefault(prefix, array('I')).append(position)
+
+            if entry.code and entry.code != 'None':
+                choices.append((entry.id, entry.code))
+
+        # replace the index at once, so concurrent
+        # searches never see a half-built index
+        self.texts = texts
+        self.grams = grams
+        self.prefixes = prefixes
+        self.choices = choices
+        self.entries = entries
+        self.version = version
+        self.checked_at = time.time()
+
+    def text_grams(self, text):
+        '''
+        returns the set of the text's trigrams
+        '''
+        size = self.gram_size
+        return set(text[i:i + size] for i in range(len(text) - size + 1))
+
+    def ensure_loaded(self):
+        '''
+        loads the index on the first use and reloads it if the ICD codes
+        were changed, the version is checked at most once per interval
+        '''
+        interval = current_app.config['ICD_CODES_INDEX_CHECK_INTERVAL']
+
+        if self.entries is not None:
+            if time.time() - self.checked_at < interval:
+                return
+
+            self.checked_at = time.time()
+
+            if self.current_version() == self.version:
+                return
+
+        self.load()
+
+    def icd_code_choices(self):
+        '''
+        returns the ICD codes choices of the GOP form. The list is shared
+        by all the forms, so it must be assigned and never changed
+        '''
+        self.ensure_loaded()
+        return self.choices
+
+    def rank(self, position, query):
+        '''
+        returns the sort key of the matched ICD code, the exact and
+        prefix code matches go first, then the matches at the beginning
+        of a term or a description, then the rest
+        '''
+        code, description, common_term = self.texts[position]
+
+        if code == query:
+            rank = 0
+        elif code.startswith(query):
+            rank = 1
+        elif common_term.startswith(query) or description.startswith(query):
+            rank = 2
+        else:
+            rank = 3
+
+        return (rank, position)
+
+    def search(self, query, limit=None):
+        '''
+        returns the ICD codes containing the query in the code,
+        description or common term, the best matches first
+        '''
+        self.ensure_loaded()
+
+        query = (query or '').lower()
+
+        if not query:
+            return []
+
+        if len(query) < self.gram_size:
+            # the query is too short to have trigrams,
+            # the codes and words starting with it are found
+            found = list(self.prefixes.get(query, ()))
+        else:
+            postings = [self.grams.get(gram) \
+                        for gram in self.text_grams(query)]
+
+            if not all(postings):
+                return []
+
+            postings.sort(key=len)
+            candidates = postings[0]
+
+            for positions in postings[1:]:
+                candidates = [position for position in candidates \
+                              if contains(positions, position)]
+
+                if not candidates:
+                    return []
+
+            # the trigrams might be found in different fields,
+            # so the candidates are checked against the query
+            found = [position for position in candidates \
+                     if any(query in text for text in self.texts[position])]
+
+        found.sort(key=lambda position: self.rank(position, query))
+
+        if limit:
+            found = found[:limit]
+
+        return [self.entries[position] for position in found]
+
+
+icd_code_index = ICDCodeIndex()
+
+
+class GOPFormChoicesCache(object):
+    '''
+    per-provider cache of the GOP form's payers and doctors choices,
+    the ICD codes choices come from the ICD codes index. Any change of
+    a payer, a doctor or the provider's payers list increases the version
+    in Redis, which drops the cached choices in every process
+    '''
+    version_key = 'gop_form_choices:version'
+
+    def __init__(self):
+        # {provider_id: (version, payers choices, doctors choices)}
+        self.cache = {}
+
+    def current_version(self):
+        '''
+        reads the choices version from Redis, if Redis is not available
+        the choices are not cached
+        '''
+        try:
+            return to_str(redis_store.get(self.version_key)) or '0'
+        except:
+            return None
+
+    def invalidate(self):
+        '''
+        drops the cached choices of all the providers in all the processes
+        '''
+        self.cache = {}
+
+        try:
+            redis_store.incr(self.version_key)
+        except:
+            pass
+
+    def provider_choices(self, provider):
+        '''
+        returns the provider's payers and doctors choices
+        '''
+        version = self.current_version()
+        cached = self.cache.get(provider.id)
+
+        if version is not None and cached and cached[0] == version:
+            return cached[1:]
+
+        payers = [(p.id, p.company) for p in provider.payers]
+        doctors = [(d.id, d.name + ' (%s)' % d.doctor_type) \
+                   for d in provider.doctors]
+
+        if version is not None:
+            self.cache[provider.id] = (version, payers, doctors)
+
+        return (payers, doctors)
+
+    def fill_form(self, form, provider, payer=None):
+        '''
+        fills in the GOP form choices, if the payer is given
+        it is the only payer to choose
+        '''
+        payers, doctors = self.provider_choices(provider)
+
+        if payer:
+            form.payer.choices = [(payer.id, payer.company)]
+        else:
+            form.payer.choices = [('0', 'None')] + payers
+
+        form.doctor_name.choices = [('0', 'None')] + doctors
+        form.icd_codes.choices = icd_code_index.icd_code_choices()
+
+
+gop_form_choices_cache = GOPFormChoicesCache()
+
+
+@event.listens_for(models.Payer, 'after_insert')
+@event.listens_for(models.Payer, 'after_update')
+@event.listens_for(models.Payer, 'after_delete')
+@event.listens_for(models.Doctor, 'after_insert')
+@event.listens_for(models.Doctor, 'after_update')
+@event.listens_for(models.Doctor, 'after_delete')
+def invalidate_gop_form_choices(mapper, connection, target):
+    '''
+    payers and doctors are shown in the GOP form choices
+    '''
+    gop_form_choices_cache.invalidate()
+
+
+@event.listens_for(models.Provider.payers, 'append')
+@event.listens_for(models.Provider.payers, 'remove')
+def invalidate_provider_payers_choices(target, value, initiator):
+    '''
+    the provider's payers list is changed
+    '''
+    gop_form_choices_cache.invalidate()
+
+
+@event.listens_for(models.ICDCode, 'after_insert')
+@event.listens_for(models.ICDCode, 'after_update')
+@event.listens_for(models.ICDCode, 'after_delete')
+def invalidate_icd_code_index(mapper, connection, target):
+    '''
+    ICD codes are shown in the search and the GOP form choices
+    '''
+    icd_code_index.invalidate()
+
+
+class GOPStatisticsService(object):
+    '''
+    counts the user's open GOP requests by status for the dashboard in
+    one grouped query. The counts are cached in Redis for a short time
+    and dropped as soon as a GOP of the scope changes its status
+    '''
+    prefix = 'gop_stats:'
+    statuses = ['pending', 'in_review', 'approved', 'declined']
+
+    def scope(self, user):
+        '''
+        returns the scope name of the user's GOPs
+        '''
+        if is_admin(user):
+            return 'all'
+        elif is_provider(user):
+            return 'provider:%d' % user.provider.id
+        elif is_payer(user):
+            return 'payer:%d' % user.payer.id
+
+        return None
+
+    def counts(self, user):
+        '''
+        returns the dictionary of the open GOPs counts by status, by
+        initial and final requests and the total count
+        '''
+        scope = self.scope(user)
+
+        if not scope:
+            return self.count_rows([])
+
+        try:
+            cached = redis_store.get(self.prefix + scope)
+        except:
+            cached = None
+
+        if cached:
+            return json.loads(to_str(cached))
+
+        counts = self.count(user)
+
+        try:
+            redis_store.setex(self.prefix + scope,
+                              current_app.config['DASHBOARD_STATS_TTL'],
+                              json.dumps(counts))
+        except:
+            pass
+
+        return counts
+
+    def count(self, user):
+        '''
+        counts the open GOPs in the database
+        '''
+        model = models.GuaranteeOfPayment
+
+        query = db.session.query(model.status, model.final,
+                                 func.count(model.id))\
+                          .filter(model.closed == False)
+
+        if is_provider(user):
+            query = query.filter(model.provider_id == user.provider.id)
+        elif is_payer(user):
+            query = query.filter(model.payer_id == user.payer.id)
+
+        return self.count_rows(query.group_by(model.status, model.final))
+
+    def count_rows(self, rows):
+        '''
+        sums up the (status, final, count) rows
+        '''
+        counts = dict((status, 0) for status in self.statuses)
+        counts.update({'initial': 0, 'final': 0, 'total': 0})
+
+        for status, final, count in rows:
+            counts[status] = counts.get(status, 0) + count
+            counts['final' if final else 'initial'] += count
+            counts['total'] += count
+
+        return counts
+
+    def invalidate(self, gop):
+        '''
+        drops the cached counts of the scopes the GOP belongs to
+        '''
+        try:
+            redis_store.delete(self.prefix + 'all',
+                               '%sprovider:%s' % (self.prefix, gop.provider_id),
+                               '%spayer:%s' % (self.prefix, gop.payer_id))
+        except:
+            pass
+
+
+gop_statistics_service = GOPStatisticsService()
+
+
+@event.listens_for(models.GuaranteeOfPayment, 'after_insert')
+@event.listens_for(models.GuaranteeOfPayment, 'after_delete')
+def invalidate_gop_statistics(mapper, connection, target):
+    '''
+    a GOP is added to or removed from the dashboard counts
+    '''
+    gop_statistics_service.invalidate(target)
+
+
+@event.listens_for(models.GuaranteeOfPayment, 'after_update')
+def invalidate_gop_statistics_on_update(mapper, connection, target):
+    '''
+    the GOP has moved between the dashboard counts
+    '''
+    attrs = inspect(target).attrs
+
+    for attr in ['status', 'closed', 'final', 'provider_id', 'payer_id']:
+        if getattr(attrs, attr).history.has_changes():
+            gop_statistics_service.invalidate(target)
+            break
+
+
+class GOPCountersService(object):
+    '''
+    running counters of the open GOP requests by provider, payer,
+    provider's country and status, kept in Redis hashes. The counters
+    are changed by the GOP mapper events and applied when the session
+    is committed, so reading them doesn't touch the GOP table
+    '''
+    prefix = 'gop_counters:'
+    groups = ['provider', 'payer', 'country', 'status']
+
+    def key(self, group):
+        return self.prefix + group
+
+    def gop_fields(self, connection, closed, status, provider_id, payer_id):
+        '''
+        returns the (group, field) pairs the GOP is counted in,
+        closed GOPs are not counted
+        '''
+        if closed:
+            return []
+
+        country = connection.execute(
+            select([models.Provider.country])\
+                .where(models.Provider.id == provider_id)).scalar()
+
+        return [('provider', provider_id),
+                ('payer', payer_id),
+                ('country', country),
+                ('status', status or 'pending')]
+
+    def add_deltas(self, session, fields, delta):
+        '''
+        stores the counters changes until the session is committed
+        '''
+        deltas = session.info.setdefault('gop_counters_deltas', {})
+
+        for field in fields:
+            deltas[field] = deltas.get(field, 0) + delta
+
+    def apply(self, deltas):
+        '''
+        changes the counters in Redis in one round trip
+        '''
+        pipe = redis_store.pipeline()
+
+        for (group, field), delta in deltas.items():
+            if delta and field is not None:
+                pipe.hincrby(self.key(group), field, delta)
+
+        pipe.execute()
+
+    def count(self, group, session=None):
+        '''
+        counts the open GOPs of the group in the database
+        '''
+        model = models.GuaranteeOfPayment
+        session = session or db.session
+
+        if group == 'country':
+            query = session.query(models.Provider.country,
+                                  func.count(model.id))\
+                .join(model, model.provider_id == models.Provider.id)\
+                .group_by(models.Provider.country)
+        else:
+            column = {'provider': model.provider_id,
+                      'payer': model.payer_id,
+                      'status': model.status}[group]
+            query = session.query(column, func.count(model.id))\
+                .group_by(column)
+
+        query = query.filter(model.closed == False)
+
+        return dict((str(field), count) for field, count in query \
+                    if field is not None)
+
+    def rebuild(self):
+        '''
+        counts the open GOPs in the database and replaces the counters,
+        the GOPs are counted in a separate session, so the rebuild
+        doesn't depend on the state of the request's session
+        '''
+        session = db.create_scoped_session()
+
+        try:
+            counts = dict((group, self.count(group, session)) \
+                          for group in self.groups)
+        finally:
+            session.remove()
+
+        pipe = redis_store.pipeline()
+
+        for group in self.groups:
+            pipe.delete(self.key(group))
+
+            if counts[group]:
+                pipe.hmset(self.key(group), counts[group])
+
+        pipe.set(self.prefix + 'ready', 1)
+        pipe.execute()
+
+    def mark_stale(self):
+        '''
+        makes the counters rebuilt from the database on the next read
+        '''
+        redis_store.delete(self.prefix + 'ready')
+
+    def read(self, group):
+        '''
+        returns the {field: count} dictionary of the counters group,
+        if Redis is not available the GOPs are counted in the database
+        '''
+        try:
+            if not redis_store.exists(self.prefix + 'ready'):
+                self.rebuild()
+
+            counters = redis_store.hgetall(self.key(group))
+        except:
+            return self.count(group)
+
+        return dict((to_str(field), int(count)) \
+                    for field, count in counters.items() if int(count) > 0)
+
+    def by_names(self, group, model):
+        '''
+        returns the (company, count) list of the counters
+        of the providers or payers group
+        '''
+        counters = self.read(group)
+
+        if not counters:
+            return []
+
+        companies = db.session.query(model.id, model.company)\
+            .filter(model.id.in_([int(id) for id in counters]))
+
+        result = {}
+
+        for id, company in companies:
+            result[company] = result.get(company, 0) + counters[str(id)]
+
+        return sorted(result.items())
+
+    def by_provider(self):
+        return self.by_names('provider', models.Provider)
+
+    def by_payer(self):
+        return self.by_names('payer', models.Payer)
+
+    def by_country(self):
+        return sorted(self.read('country').items())
+
+
+gop_counters_service = GOPCountersService()
+
+
+def gop_history_value(target, attr):
+    '''
+    returns the value the GOP's attribute had before the flush
+    '''
+    history = getattr(inspect(target).attrs, attr).history
+
+    if history.deleted:
+        return history.deleted[0]
+
+    return getattr(target, attr)
+
+
+@event.listens_for(models.GuaranteeOfPayment, 'after_insert')
+def count_inserted_gop(mapper, connection, target):
+    fields = gop_counters_service.gop_fields(connection, target.closed,
+        target.status, target.provider_id, target.payer_id)
+    gop_counters_service.add_deltas(object_session(target), fields, 1)
+
+
+@event.listens_for(models.GuaranteeOfPayment, 'after_delete')
+def count_deleted_gop(mapper, connection, target):
+    fields = gop_counters_service.gop_fields(connection, target.closed,
+        target.status, target.provider_id, target.payer_id)
+    gop_counters_service.add_deltas(object_session(target), fields, -1)
+
+
+@event.listens_for(models.GuaranteeOfPayment, 'after_update')
+def count_updated_gop(mapper, connection, target):
+    attrs = ['closed', 'status', 'provider_id', 'payer_id']
+
+    old = [gop_history_value(target, attr) for attr in attrs]
+    new = [getattr(target, attr) for attr in attrs]
+
+    if old == new:
+        return
+
+    session = object_session(target)
+    gop_counters_service.add_deltas(session,
+        gop_counters_service.gop_fields(connection, *old), -1)
+    gop_counters_service.add_deltas(session,
+        gop_counters_service.gop_fields(connection, *new), 1)
+
+
+@event.listens_for(models.Provider, 'after_update')
+def recount_provider_country(mapper, connection, target):
+    '''
+    the provider's GOPs are moved to another country, the counters
+    are marked stale after the commit and rebuilt on the next read
+    '''
+    if inspect(target).attrs.country.history.has_changes():
+        object_session(target).info['gop_counters_rebuild'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def apply_gop_counters(session):
+    # the session can't emit SQL after the commit, so only the Redis
+    # deltas are applied here, the rebuild is left to the next read
+    deltas = session.info.pop('gop_counters_deltas', None)
+    rebuild = session.info.pop('gop_counters_rebuild', False)
+
+    try:
+        if rebuild:
+            gop_counters_service.mark_stale()
+        elif deltas:
+            gop_counters_service.apply(deltas)
+    except:
+        # the counters might be wrong now, so they will be
+        # rebuilt from the database on the next read
+        try:
+            gop_counters_service.mark_stale()
+        except:
+            pass
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_gop_counters(session):
+    session.info.pop('gop_counters_deltas', None)
+    session.info.pop('gop_counters_rebuild', None)
+
+
+@event.listens_for(models.GuaranteeOfPayment, 'after_insert')
+def index_inserted_gop(mapper, connection, target):
+    gop_search_service.mark(object_session(target), [target.id])
+
+
+@event.listens_for(models.GuaranteeOfPayment, 'after_update')
+def index_updated_gop(mapper, connection, target):
+    session = object_session(target)
+    old = [gop_history_value(target, attr) \
+           for attr in ['provider_id', 'payer_id']]
+
+    if old != [target.provider_id, target.payer_id]:
+        gop_search_service.mark_scope(session, target.id, *old)
+
+    gop_search_service.mark(session, [target.id])
+
+
+@event.listens_for(models.GuaranteeOfPayment, 'after_delete')
+def index_deleted_gop(mapper, connection, target):
+    gop_search_service.mark_removed(object_session(target), target.id,
+                                    target.provider_id, target.payer_id)
+
+
+def reindex_related_gops(connection, target, attrs, column):
+    '''
+    marks the GOPs of the changed member or payer to be reindexed,
+    if any of its searchable fields is changed
+    '''
+    state = inspect(target)
+
+    if not any(getattr(state.attrs, attr).history.has_changes() \
+               for attr in attrs):
+        return
+
+    model = models.GuaranteeOfPayment
+    gop_ids = [gop_id for gop_id, in connection.execute(
+        select([model.id]).where(column == target.id))]
+
+    if gop_ids:
+        gop_search_service.mark(object_session(target), gop_ids)
+
+
+@event.listens_for(models.Member, 'after_update')
+def index_member_gops(mapper, connection, target):
+    reindex_related_gops(connection, target, ['name', 'gender', 'tel'],
+                         models.GuaranteeOfPayment.member_id)
+
+
+@event.listens_for(models.Payer, 'after_update')
+def index_payer_gops(mapper, connection, target):
+    reindex_related_gops(connection, target, ['company'],
+                         models.GuaranteeOfPayment.payer_id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def apply_gop_search_index(session):
+    gop_ids = session.info.pop('gop_search_reindex', set())
+    scopes = session.info.pop('gop_search_scopes', set())
+    removed = session.info.pop('gop_search_remove', set())
+
+    if gop_ids or scopes or removed:
+        # the index is not critical, it's rebuilt by reindex_search
+        try:
+            gop_search_service.apply(gop_ids, scopes, removed)
+        except:
+            pass
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_gop_search_index(session):
+    session.info.pop('gop_search_reindex', None)
+    session.info.pop('gop_search_scopes', None)
+    session.info.pop('gop_search_remove', None)
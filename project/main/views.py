@@ -8,10 +8,11 @@ import time
 
 from datetime import datetime
 
-from flask import flash, jsonify, render_template, redirect, request, session
+from flask import current_app, flash, jsonify, render_template, redirect
+from flask import request, session
 from flask import make_response, send_from_directory, url_for
 from flask_login import current_user, login_user
-from sqlalchemy import and_, or_
+from sqlalchemy import and_
 
 from . import main
 from .forms import GOPForm, GOPApproveForm
@@ -20,7 +21,9 @@ from .helpers import to_float_or_zero, validate_email_address
 from .helpers import prepare_gops_list, notify, is_admin, is_provider, is_payer
 from .services import GuaranteeOfPaymentService, UserService, ICDCodeService
 from .services import MedicalDetailsService, MemberService
-from .. import config, create_app, db, redis_store, models
+from .services import gop_search_service, icd_code_index
+from .services import gop_form_choices_cache, gop_statistics_service
+from .. import config, create_app, db, notifications, redis_store, models
 from .. import auth
 from ..auth.forms import LoginForm
 from ..auth.views import login_validation
@@ -69,12 +72,19 @@ def index():
     else:
         gops = user_gops
 
-    in_review_count = user_gops.filter_by(status='in_review').count()
-    approved_count = user_gops.filter_by(status='approved').count()
-    rejected_count = user_gops.filter_by(status='declined').count()
-    pending_count = user_gops.filter_by(status='pending').count()
+    counts = gop_statistics_service.counts(current_user)
 
-    total_count = gops.count()
+    in_review_count = counts['in_review']
+    approved_count = counts['approved']
+    rejected_count = counts['declined']
+    pending_count = counts['pending']
+
+    # the total count of the chosen GOPs list
+    if status in ['approved', 'declined', 'in_review', 'pending',
+                  'initial', 'final']:
+        total_count = counts[status]
+    else:
+        total_count = counts['total']
 
     today = datetime.now()
 
@@ -112,15 +122,7 @@ def request_form():
     '''
     form = GOPForm()
 
-    form.payer.choices = [('0', 'None')]
-    form.payer.choices += [(p.id, p.company) for p \
-                           in current_user.provider.payers]
-
-    form.icd_codes.choices = [(i.id, i.code) for i in ICDCode.query.all()]
-
-    form.doctor_name.choices = [('0', 'None')]
-    form.doctor_name.choices += [(d.id, d.name + ' (%s)' % d.doctor_type) \
-                                 for d in current_user.provider.doctors]
+    gop_form_choices_cache.fill_form(form, current_user.provider)
 
     # fixes a validation error when user didn't
     # fill in the previous admitted date field
@@ -375,13 +377,8 @@ def request_page_edit(gop_id):
     form = GOPForm()
 
     # Provider cannot change a payer while editing
-    form.payer.choices = [(gop.payer.id, gop.payer.company)]
-
-    form.icd_codes.choices = [(i.id, i.code) for i in ICDCode.query.all()]
-
-    form.doctor_name.choices = [('0', 'None')]
-    form.doctor_name.choices += [(d.id, d.name + ' (%s)' % d.doctor_type) \
-                                 for d in current_user.provider.doctors]
+    gop_form_choices_cache.fill_form(form, current_user.provider,
+                                     payer=gop.payer)
 
     final = request.args.get('final', None)
 
@@ -586,31 +583,7 @@ def search():
     if not query or not current_user.is_authenticated:
         return jsonify(found)
 
-    query = query.lower()
-
-    if is_admin(current_user):
-        gops = gop_service.all()
-    elif is_provider(current_user):
-        gops = gop_service.find(provider_id=current_user.provider.id)
-    elif is_payer(current_user):
-        gops = gop_service.find(payer_id=current_user.payer.id)
-
-    for gop in gops:
-        # if query in gop.icd_codes.lower() \
-        if query in gop.patient_action_plan.lower() \
-        or query in gop.doctor_name.lower() \
-        or query in str(gop.room_price) \
-        or query in gop.room_type.lower() \
-        or query in str(gop.patient_medical_no) \
-        or query in str(gop.doctor_fee) \
-        or query in str(gop.surgery_fee) \
-        or query in str(gop.medication_fee) \
-        or query in gop.member.name.lower() \
-        or query in gop.member.gender.lower() \
-        or query in str(gop.member.tel) \
-        or (gop.payer.company and query in gop.payer.company.lower()):
-            found['results'].append(gop.id)
-            continue
+    found['results'] = gop_search_service.search(query, current_user)
 
     return jsonify(found)
 
@@ -620,37 +593,48 @@ def icd_code_search():
     '''
     gets the result of the icd code search results for the icd pop up menu
     '''
-    query = request.args.get('query').lower()
+    query = (request.args.get('query') or '').lower()
     
     if not query:
         return render_template('icd-code-search-results.html',
                                icd_codes=None, query=query)
 
-    # icd_codes = ICDCode.query.all()
+    try:
+        page = int(request.args.get('page'))
+    except (ValueError, TypeError):
+        page = 1
 
-    icd_codes = ICDCode.query.filter(ICDCode.id > 0)
-    fields = ['code', 'description', 'common_term']
+    pagination, icd_codes = icd_code_service.search(query, page=page)
 
-    def find(model, obj, attrs, search):
-        search = '%{0}%'.format(search)
+    return render_template('icd-code-search-results.html', icd_codes=icd_codes,
+                           query=query, pagination=pagination)
 
-        expessions = []
-        for attr in attrs:
-            expessions.append(getattr(model, attr).ilike(search))
 
-        return obj.filter(or_(*expessions))
+@main.route('/icd-code/autocomplete', methods=['GET'])
+def icd_code_autocomplete():
+    '''
+    returns the best matching icd codes for the query in json format
+    '''
+    found = {
+        'results': []
+    }
+    query = request.args.get('query')
 
-    icd_codes = find(ICDCode, icd_codes, fields, query)
+    if not query or not current_user.is_authenticated:
+        return jsonify(found)
 
-    pagination, icd_codes = icd_code_service.prepare_pagination(icd_codes)
+    limit = current_app.config['ICD_CODES_AUTOCOMPLETE_LIMIT']
+    max_limit = current_app.config['ICD_CODES_AUTOCOMPLETE_MAX_LIMIT']
 
     try:
-        icd_codes = icd_codes.all()
-    except:
+        limit = min(int(request.args.get('limit')), max_limit)
+    except (ValueError, TypeError):
         pass
 
-    return render_template('icd-code-search-results.html', icd_codes=icd_codes,
-                           query=query, pagination=pagination)
+    for icd_code in icd_code_index.search(query, limit=limit):
+        found['results'].append(icd_code._asdict())
+
+    return jsonify(found)
 
 
 @main.route('/requests/filter', methods=['GET'])
@@ -782,7 +766,10 @@ def get_gops():
         elif sort == 'time':
             gops = gops.group_by(GuaranteeOfPayment.turnaround_time)
 
-    if page or pagination.pages > 1:
+    # load the GOPs with their relations in a batch
+    gops = gop_service.eager_load(gops)
+
+    if page:
         try:
             page = int(page)
         except (ValueError, TypeError):
@@ -792,3 +779,28 @@ def get_gops():
     gops = gops.all()
 
     return jsonify(prepare_gops_list(gops))
+
+
+@main.route('/notifications', methods=['GET'])
+@login_required()
+def notifications_pending():
+    '''
+    gets all the user's unread notifications in json format, the ones
+    sent after the 'since' timestamp if it's passed
+    '''
+    unread = notifications.unread(current_user.id,
+                                  since=request.args.get('since'))
+
+    return jsonify({'notifications': unread})
+
+
+@main.route('/notifications/read', methods=['POST'])
+@login_required()
+def notifications_read():
+    '''
+    marks the notifications with the posted ids or all of them as read
+    '''
+    data = request.get_json(silent=True) or {}
+    notifications.mark_read(current_user.id, data.get('ids'))
+
+    return jsonify({'notifications': notifications.unread(current_user.id)})
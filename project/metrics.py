@@ -0,0 +1,355 @@
+'''
+Prometheus-style metrics of the app, served as text by /metrics
+
+the metrics are kept in the memory of each worker process,
+so every worker is scraped separately, the metrics of the background
+workers are kept in Redis and served by every web worker
+'''
+import json
+import os
+import time
+
+from flask import Response, abort, current_app, g, request
+from flask_mail import Mail
+from redis import StrictRedis
+from redis.client import StrictPipeline
+
+
+# the default buckets of the Prometheus client libraries, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5,
+                   0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+START_TIME = time.time()
+
+# any other method is counted as 'OTHER', so the labels stay bounded
+HTTP_METHODS = set(['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE',
+                    'OPTIONS'])
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n')\
+                     .replace('"', '\\"')
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+
+    if extra:
+        pairs.append(extra)
+
+    if not pairs:
+        return ''
+
+    return '{' + ','.join('%s="%s"' % (name, escape(value)) \
+                          for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+
+class Metric(object):
+    '''
+    the base class of the metrics with the labels
+    '''
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+        # {label values: value}
+        self.values = {}
+
+    def header(self):
+        return ['# HELP %s %s' % (self.name, self.documentation),
+                '# TYPE %s %s' % (self.name, self.kind)]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, label_values, amount=1):
+        label_values = tuple(label_values)
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = self.header()
+
+        for label_values, value in sorted(self.values.items()):
+            lines.append('%s%s %s' % (
+                self.name, format_labels(self.labels, label_values),
+                format_value(value)))
+
+        return lines
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, label_values, value):
+        label_values = tuple(label_values)
+
+        # [bucket counts, sum, count]
+        data = self.values.get(label_values)
+
+        if data is None:
+            data = self.values[label_values] = [[0] * len(self.buckets),
+                                                0.0, 0]
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[0][i] += 1
+
+        data[1] += value
+        data[2] += 1
+
+    def collect(self):
+        '''
+        returns the {label values: [bucket counts, sum, count]}
+        '''
+        return self.values
+
+    def render(self):
+        lines = self.header()
+
+        for label_values, (counts, total, count) in \
+                sorted(self.collect().items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append('%s_bucket%s %s' % (
+                    self.name,
+                    format_labels(self.labels, label_values,
+                                  ('le', format_value(bound))),
+                    format_value(bucket_count)))
+
+            labels = format_labels(self.labels, label_values)
+            lines.append('%s_sum%s %s' % (self.name, labels,
+                                          format_value(total)))
+            lines.append('%s_count%s %s' % (self.name, labels,
+                                            format_value(count)))
+
+        return lines
+
+
+class SharedHistogram(Histogram):
+    '''
+    the histogram kept in Redis, so the observations of the background
+    workers are served by the /metrics of every web worker
+    '''
+    def key(self, label_values):
+        return 'metrics:%s:%s' % (self.name, json.dumps(label_values))
+
+    def labels_key(self):
+        return 'metrics:%s:labels' % self.name
+
+    def observe(self, label_values, value):
+        from . import redis_store
+
+        label_values = list(label_values)
+        key = self.key(label_values)
+
+        try:
+            pipe = redis_store.pipeline(transaction=False)
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    pipe.hincrby(key, i, 1)
+
+            pipe.hincrbyfloat(key, 'sum', value)
+            pipe.hincrby(key, 'count', 1)
+            pipe.sadd(self.labels_key(), json.dumps(label_values))
+            pipe.execute()
+        except:
+            pass
+
+    def collect(self):
+        from . import redis_store
+        from .main.helpers import to_str
+
+        try:
+            labels = [json.loads(to_str(label_values)) for label_values \
+                      in redis_store.smembers(self.labels_key())]
+
+            pipe = redis_store.pipeline(transaction=False)
+
+            for label_values in labels:
+                pipe.hgetall(self.key(label_values))
+
+            rows = pipe.execute()
+        except:
+            return {}
+
+        values = {}
+
+        for label_values, row in zip(labels, rows):
+            row = dict((to_str(k), float(v)) for k, v in row.items())
+            values[tuple(label_values)] = [
+                [row.get(str(i), 0) for i in range(len(self.buckets))],
+                row.get('sum', 0.0),
+                row.get('count', 0)]
+
+        return values
+
+
+http_requests = Counter(
+    'medipay_http_requests_total',
+    'The number of the HTTP requests.',
+    ['endpoint', 'method', 'status'])
+http_request_duration = Histogram(
+    'medipay_http_request_duration_seconds',
+    'The latency of the HTTP requests.',
+    ['endpoint'])
+db_queries = Counter(
+    'medipay_db_queries_total',
+    'The number of the database queries by endpoint or Socket.IO event.',
+    ['endpoint'])
+db_time = Counter(
+    'medipay_db_time_seconds_total',
+    'The time spent in the database by endpoint or Socket.IO event.',
+    ['endpoint'])
+redis_duration = Histogram(
+    'medipay_redis_command_duration_seconds',
+    'The latency of the Redis commands and pipelines.',
+    ['command'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+             0.5, 1.0))
+socketio_events = Counter(
+    'medipay_socketio_events_total',
+    'The number of the handled Socket.IO events.',
+    ['event'])
+# the emails are sent by the mail worker, so it's shared through Redis
+mail_duration = SharedHistogram(
+    'medipay_mail_send_duration_seconds',
+    'The time of sending the emails.',
+    ['status'])
+
+METRICS = [http_requests, http_request_duration, db_queries, db_time,
+           redis_duration, socketio_events, mail_duration]
+
+
+def observe_queries(name, count, elapsed):
+    db_queries.inc([name], count)
+    db_time.inc([name], elapsed)
+
+
+def count_event(name):
+    socketio_events.inc([name])
+
+
+class InstrumentedPipeline(StrictPipeline):
+    '''
+    the Redis pipeline, which times its execution
+    '''
+    def execute(self, *args, **kwargs):
+        started = time.time()
+
+        try:
+            return super(InstrumentedPipeline, self).execute(*args, **kwargs)
+        finally:
+            redis_duration.observe(['PIPELINE'], time.time() - started)
+
+
+class InstrumentedRedis(StrictRedis):
+    '''
+    the Redis client, which times the commands
+    '''
+    def execute_command(self, *args, **options):
+        started = time.time()
+
+        try:
+            return super(InstrumentedRedis, self).execute_command(*args,
+                                                                  **options)
+        finally:
+            redis_duration.observe([str(args[0])], time.time() - started)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool,
+                                    self.response_callbacks,
+                                    transaction,
+                                    shard_hint)
+
+
+class InstrumentedMail(Mail):
+    '''
+    the Flask-Mail extension, which times sending the emails
+    '''
+    def send(self, message):
+        started = time.time()
+        status = 'error'
+
+        try:
+            result = super(InstrumentedMail, self).send(message)
+            status = 'sent'
+            return result
+        finally:
+            mail_duration.observe([status], time.time() - started)
+
+
+def render():
+    lines = []
+
+    for metric in METRICS:
+        lines.extend(metric.render())
+
+    lines.append('# HELP medipay_process_start_time_seconds '
+                 'The start time of the worker process.')
+    lines.append('# TYPE medipay_process_start_time_seconds gauge')
+    lines.append('medipay_process_start_time_seconds{pid="%d"} %s' % (
+        os.getpid(), format_value(START_TIME)))
+
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view():
+    '''
+    serves the metrics, if METRICS_TOKEN is set, the scraper must
+    send it as the bearer token or as the 'token' query parameter,
+    without the token the metrics are served only if METRICS_PUBLIC
+    '''
+    token = current_app.config['METRICS_TOKEN']
+
+    if token:
+        authorization = request.headers.get('Authorization', '')
+
+        if authorization != 'Bearer ' + token and \
+                request.args.get('token') != token:
+            abort(403)
+    elif not current_app.config['METRICS_PUBLIC']:
+        abort(404)
+
+    return Response(render(), content_type=CONTENT_TYPE)
+
+
+def init_app(app):
+    '''
+    registers the request hooks and the /metrics endpoint
+    '''
+    @app.before_request
+    def start_request_timer():
+        g.metrics_start_time = time.time()
+
+    @app.after_request
+    def observe_request(response):
+        started = getattr(g, 'metrics_start_time', None)
+        endpoint = request.endpoint or 'unknown'
+        method = request.method if request.method in HTTP_METHODS \
+            else 'OTHER'
+
+        if started is not None and endpoint != 'metrics':
+            http_request_duration.observe([endpoint], time.time() - started)
+            http_requests.inc([endpoint, method, str(response.status_code)])
+
+        return response
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
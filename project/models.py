@@ -1,14 +1,14 @@
 import json, requests
 
-from datetime import datetime, date
+from datetime import datetime, date, time, timedelta
 from dateutil.relativedelta import relativedelta
+from decimal import Decimal, InvalidOperation
 
 from flask import redirect, url_for
 from flask_login import current_user, UserMixin
 from functools import wraps
-from sqlalchemy import extract
-from sqlalchemy.orm import class_mapper, ColumnProperty
-from sqlalchemy.sql import func
+from sqlalchemy import and_
+from sqlalchemy.orm import class_mapper, ColumnProperty, validates
 from werkzeug import check_password_hash, generate_password_hash
 
 from . import db, login_manager
@@ -47,6 +47,37 @@ def to_float_or_zero(value):
     return value
 
 
+def to_decimal_or_none(value):
+    '''
+    converts an amount string like '$ 1,200.50' to a Decimal
+    with 2 decimal places, returns None if it isn't a valid amount
+    '''
+    if value is None:
+        return None
+
+    if isinstance(value, (int, float, Decimal)):
+        value = str(value)
+
+    value = value.replace(',', '').replace('$', '').strip()
+
+    try:
+        value = Decimal(value)
+
+        # 'NaN' and 'Infinity' parse, but aren't amounts
+        if not value.is_finite():
+            return None
+
+        value = value.quantize(Decimal('0.01'))
+
+        # the amount must fit the NUMERIC(12, 2) column
+        if abs(value) >= Decimal('1e10'):
+            return None
+    except (InvalidOperation, ValueError):
+        return None
+
+    return value
+
+
 class ColsMapMixin(object):
     @classmethod
     def columns(cls):
@@ -70,7 +101,7 @@ class User(UserMixin, ColsMapMixin, db.Model):
     bad_logins = db.Column(db.Integer)
     last_attempt = db.Column(db.DateTime)
     last_login_ip = db.Column(db.String(128))
-    api_key = db.Column(db.String(128))
+    api_key = db.Column(db.String(128), index=True)
     premium = db.Column(db.SmallInteger)
 
     messages = db.relationship('ChatMessage', backref='user', lazy='dynamic')
@@ -122,7 +153,7 @@ class Member(ColsMapMixin, db.Model):
     gender = db.Column(db.String(20))
     tel = db.Column(db.String(80))
     policy_number = db.Column(db.String(127))
-    national_id = db.Column(db.String(127))
+    national_id = db.Column(db.String(127), index=True)
     email = db.Column(db.String(64))
     address = db.Column(db.String(127))
     address_additional = db.Column(db.String(127))
@@ -141,7 +172,7 @@ class Member(ColsMapMixin, db.Model):
     sequence = db.Column(db.String(127))
     patient_type = db.Column(db.String(50))
     raiting = db.Column(db.String(50))
-    device_uid = db.Column(db.String(127))
+    device_uid = db.Column(db.String(127), index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     claims = db.relationship('Claim', backref='member', lazy='dynamic')
     medical_records = db.relationship('MedicalRecord', backref='member',
@@ -281,7 +312,7 @@ class Terminal(ColsMapMixin, db.Model):
     version = db.Column(db.String(40))
     last_update = db.Column(db.DateTime, default=datetime.now())
     remarks = db.Column(db.String(100))
-    device_uid = db.Column(db.String(127))
+    device_uid = db.Column(db.String(127), index=True)
     provider_id = db.Column(db.Integer, db.ForeignKey('provider.id'))
     claims = db.relationship('Claim', backref='terminal', lazy='dynamic')
 
@@ -302,72 +333,65 @@ def date_months_ago(months):
 
 class Claim(ColsMapMixin, db.Model):
     __tablename__ = 'claim'
+    __table_args__ = (
+        db.Index('ix_claim_provider_id_datetime', 'provider_id', 'datetime'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     status = db.Column(db.String(40))
-    claim_number = db.Column(db.String(80))
+    claim_number = db.Column(db.String(80), index=True)
     claim_type = db.Column(db.String(80))
     datetime = db.Column(db.DateTime)
     admitted = db.Column(db.String(40))
     discharged = db.Column(db.String(40))
     amount = db.Column(db.String(127))
+    # the numeric value of the amount, which is used by the SQL aggregates
+    amount_value = db.Column(db.Numeric(12, 2))
     icd_code = db.Column(db.String(127))
     gop_id = db.Column(db.Integer, db.ForeignKey('guarantee_of_payment.id'))
     provider_id = db.Column(db.Integer, db.ForeignKey('provider.id'))
     member_id = db.Column(db.Integer, db.ForeignKey('member.id'))
     terminal_id = db.Column(db.Integer, db.ForeignKey('terminal.id'))
-    new_claim = db.Column(db.SmallInteger, default=0)
+    new_claim = db.Column(db.SmallInteger, default=0, index=True)
 
-    @classmethod
-    def for_months_filter(cls, query_object, months, _type='all'):
+    @validates('amount')
+    def validate_amount(self, key, amount):
         '''
-        the filter returns a query within a given month
-        and for the whole range from today to that month
-
-        '_type' may be either 'all' or 'scalar'
-        by 'all' it returns an objects list
-        by 'scalar' it returns object's value summ
-
-        select records whose date is between
-        today and some month in the past
+        keeps the numeric amount value in sync with the amount string
         '''
+        self.amount_value = to_decimal_or_none(amount)
+        return amount
 
-        for_range = query_object.filter(cls.datetime and \
-            cls.datetime.between(date_months_ago(months), date.today()))
-
-        # select records whose month and year 
-        # coincide with the given date in the past
-        ago = query_object.filter(cls.datetime and \
-          extract('month', cls.datetime) == date_months_ago(months).month and \
-          extract('year', cls.datetime) == date_months_ago(months).year)
-
-        # if the type of a final operation is 'scalar'
-        # it summarizes the given records' values
-        if _type == 'scalar':
-            return (for_range.scalar(), ago.scalar())
+    @staticmethod
+    def range_bounds(months, today=None):
+        '''
+        returns the half-open [start, end) datetime bounds of the range
+        from the day the given months ago to the end of today
+        '''
+        today = today or date.today()
+        start = today + relativedelta(months=months * -1)
 
-        # otherwise it just returns the list of given records
-        return (for_range.all(), ago.all())
+        return (datetime.combine(start, time.min),
+                datetime.combine(today + timedelta(days=1), time.min))
 
-    @classmethod
-    def for_months(cls, months):
+    @staticmethod
+    def month_bounds(months, today=None):
         '''
-        returns a tuple of claims within a given month
-        and for the whole range from today to that month
+        returns the half-open [start, end) datetime bounds
+        of the calendar month the given months ago
         '''
-        return cls.for_months_filter(cls.query, months)
+        today = today or date.today()
+        start = (today + relativedelta(months=months * -1)).replace(day=1)
+
+        return (datetime.combine(start, time.min),
+                datetime.combine(start + relativedelta(months=1), time.min))
 
     @classmethod
-    def amount_sum(cls, months=0):
+    def in_bounds(cls, bounds):
         '''
-        returns a tuple with a total amount, amount for the given
-        month ago and for the whole range from today to the given month
+        the datetime condition of the bounds, which can use the index
         '''
-        # base query which uses the SQL function 'sum'
-        query = db.session.query(func.sum(cls.amount))
-
-        # concatenate the tuple of a total amount and month amounts
-        return (query.scalar(),) + cls.for_months_filter(query, months,
-                                                        _type='scalar')
+        start, end = bounds
+        return and_(cls.datetime >= start, cls.datetime < end)
 
 
 class Contract(db.Model):
@@ -431,6 +455,12 @@ class Payer(ColsMapMixin, db.Model):
 
 class GuaranteeOfPayment(ColsMapMixin ,db.Model):
     __tablename__ = 'guarantee_of_payment'
+    __table_args__ = (
+        db.Index('ix_guarantee_of_payment_provider_id_closed_status',
+                 'provider_id', 'closed', 'status'),
+        db.Index('ix_guarantee_of_payment_payer_id_closed_status',
+                 'payer_id', 'closed', 'status'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     provider_id = db.Column(db.Integer, db.ForeignKey('provider.id'))
     payer_id = db.Column(db.Integer, db.ForeignKey('payer.id'))
@@ -528,6 +558,10 @@ class Chat(ColsMapMixin, db.Model):
 
 class ChatMessage(ColsMapMixin, db.Model):
     __tablename__ = 'chat_message'
+    __table_args__ = (
+        db.Index('ix_chat_message_chat_id_datetime', 'chat_id', 'datetime',
+                 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.Text)
     chat_id = db.Column(db.Integer, db.ForeignKey('chat.id'))
@@ -0,0 +1,240 @@
+'''
+the users' notifications inbox and its dispatcher
+
+every notification is kept in the user's inbox, a sorted set of the
+notifications scored by their time, bounded by the number of the
+notifications and their age. The ids of the unread ones are kept
+in a hash, so the whole inbox and its read state are fetched in one
+pipelined round trip. The reconnected clients send the time of the
+newest notification they have got, so each of them gets only the
+unread notifications it has missed.
+
+the emits are coalesced by user and room: the first notification is
+emitted at once and the ones sent during the next few seconds are
+emitted as one digest with their count. If the digest isn't sent in
+time, the notifications are emitted at once again
+'''
+import json
+import time
+import uuid
+
+from datetime import datetime
+
+from flask import current_app
+
+from . import redis_store, socketio
+from .main.helpers import emit_to_room, to_str
+
+
+NOTIFICATIONS_PREFIX = 'notifications:'
+
+
+def window_key(user_id, group):
+    return '%swindow:%s:%s' % (NOTIFICATIONS_PREFIX, user_id, group)
+
+
+def inbox_key(user_id):
+    return '%sinbox:%s' % (NOTIFICATIONS_PREFIX, user_id)
+
+
+def unread_key(user_id):
+    return '%sunread_ids:%s' % (NOTIFICATIONS_PREFIX, user_id)
+
+
+def send(user_id, notification):
+    emit_to_room('message', notification, room=user_id)
+
+
+def send_digest(key, user_id, window):
+    '''
+    waits for the end of the window and emits the number
+    of the notifications sent during it with the last of them
+    '''
+    socketio.sleep(window)
+
+    try:
+        pipe = redis_store.pipeline()
+        pipe.hgetall(key)
+        pipe.delete(key)
+        values, _ = pipe.execute()
+    except:
+        return
+
+    values = dict((to_str(k), to_str(v)) for k, v in values.items())
+    count = int(values.get('count', 0))
+
+    # the first notification of the window is sent already
+    if count > 1 and values.get('last'):
+        notification = json.loads(values['last'])
+        notification['count'] = count - 1
+        send(user_id, notification)
+
+
+def trim_inbox(pipe, user_id, now):
+    '''
+    keeps only the latest notifications of the retention period
+    '''
+    config = current_app.config
+    retention = config['NOTIFICATIONS_RETENTION_DAYS'] * 86400
+
+    pipe.zremrangebyscore(inbox_key(user_id), '-inf', now - retention)
+    pipe.zremrangebyrank(inbox_key(user_id), 0,
+                         -config['NOTIFICATIONS_INBOX_LIMIT'] - 1)
+    pipe.expire(inbox_key(user_id), retention)
+    pipe.expire(unread_key(user_id), retention)
+
+
+def dispatch(user_id, title, message, url=None, room_name=None):
+    '''
+    adds the notification to the user's inbox
+    and emits it or adds it to the digest of its room
+    '''
+    window = current_app.config['NOTIFICATIONS_COALESCE_WINDOW']
+    now = time.time()
+
+    notification = {
+        'id': uuid.uuid4().hex,
+        'title': title,
+        'message': message,
+        'url': url,
+        'room_name': room_name,
+        'datetime': datetime.now().isoformat(),
+        'timestamp': now,
+        'count': 1
+    }
+    key = window_key(user_id, room_name or url or title)
+
+    try:
+        pipe = redis_store.pipeline()
+
+        if window:
+            pipe.hincrby(key, 'count', 1)
+            pipe.hsetnx(key, 'started', now)
+            pipe.hget(key, 'started')
+            pipe.hset(key, 'last', json.dumps(notification))
+            # the window is dropped, even if its digest is never sent,
+            # it outlives the digest task, which reads it after the window
+            pipe.expire(key, window * 2)
+
+        pipe.zadd(inbox_key(user_id), now, json.dumps(notification))
+        pipe.hset(unread_key(user_id), notification['id'], now)
+        trim_inbox(pipe, user_id, now)
+
+        results = pipe.execute()
+    except:
+        send(user_id, notification)
+        return
+
+    if not window:
+        send(user_id, notification)
+    elif results[0] == 1:
+        send(user_id, notification)
+        socketio.start_background_task(send_digest, key, user_id, window)
+    elif now - float(to_str(results[2])) > window * 2:
+        # the digest should have been sent, its task has died
+        send(user_id, notification)
+
+        try:
+            redis_store.delete(key)
+        except:
+            pass
+
+
+def inbox(user_id):
+    '''
+    returns all the user's notifications, from the newest to the
+    oldest, each of them with its 'read' state
+    '''
+    retention = current_app.config['NOTIFICATIONS_RETENTION_DAYS'] * 86400
+
+    try:
+        pipe = redis_store.pipeline(transaction=False)
+        pipe.zrevrangebyscore(inbox_key(user_id), '+inf',
+                              time.time() - retention)
+        pipe.hkeys(unread_key(user_id))
+        rows, unread_ids = pipe.execute()
+    except:
+        return []
+
+    unread_ids = set(to_str(unread_id) for unread_id in unread_ids)
+    notifications = []
+
+    for row in rows:
+        notification = json.loads(to_str(row))
+        notification['read'] = notification['id'] not in unread_ids
+        unread_ids.discard(notification['id'])
+        notifications.append(notification)
+
+    # the unread ids of the notifications dropped from the inbox
+    if unread_ids:
+        try:
+            redis_store.hdel(unread_key(user_id), *unread_ids)
+        except:
+            pass
+
+    return notifications
+
+
+def unread(user_id, since=None):
+    '''
+    returns the user's unread notifications sent after
+    the 'since' timestamp, from the newest to the oldest
+    '''
+    try:
+        since = float(since) if since else None
+    except (TypeError, ValueError):
+        since = None
+
+    return [notification for notification in inbox(user_id) \
+            if not notification['read'] and \
+               (since is None or notification['timestamp'] > since)]
+
+
+def page(user_id, before=None, limit=None):
+    '''
+    returns a page of the user's notifications, from the newest to
+    the oldest, and the cursor of the next page or None if it's the
+    last one. The cursor is the timestamp of the page's oldest one
+    '''
+    max_limit = current_app.config['NOTIFICATIONS_MAX_PAGE_SIZE']
+    limit = limit or current_app.config['NOTIFICATIONS_PAGE_SIZE']
+    limit = max(1, min(limit, max_limit))
+
+    notifications = inbox(user_id)
+
+    try:
+        before = float(before) if before else None
+    except (TypeError, ValueError):
+        before = None
+
+    if before is not None:
+        notifications = [notification for notification in notifications \
+                         if notification['timestamp'] < before]
+
+    cursor = notifications[limit - 1]['timestamp'] \
+        if len(notifications) > limit else None
+
+    return (notifications[:limit], cursor)
+
+
+def mark_read(user_id, ids=None, room_name=None):
+    '''
+    marks the notifications with the ids, the ones of the room
+    or all of them as read
+    '''
+    if ids is not None and not isinstance(ids, (list, tuple)):
+        return
+
+    if room_name is not None:
+        ids = [notification['id'] for notification in inbox(user_id) \
+               if notification.get('room_name') == room_name and \
+                  not notification['read']]
+
+    try:
+        if ids is None:
+            redis_store.delete(unread_key(user_id))
+        elif ids:
+            redis_store.hdel(unread_key(user_id), *[str(i) for i in ids])
+    except:
+        pass
+
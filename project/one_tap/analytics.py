@@ -0,0 +1,303 @@
+from calendar import month_abbr
+from datetime import datetime
+
+import numpy as np
+
+from sqlalchemy import case, func
+
+from .helpers import percent_of
+from .. import models
+from ..models import monthdelta, to_float_or_zero
+
+
+# the rolling windows, in months, shown on the 1TAP dashboard
+RANGE_MONTHS = [0, 1, 3, 5, 6, 24]
+
+# the calendar months in the past, whose amounts are shown
+AMOUNT_MONTHS = [0, 1, 2, 3, 4, 5, 6, 24]
+
+# the windows of the cost and ICD code histograms and their names
+HISTOGRAM_MONTHS = {
+    1: '1_month',
+    3: '3_months',
+    6: '6_months',
+    24: '24_months'
+}
+
+
+class ClaimsSummary(object):
+    '''
+    figures of the 1TAP dashboard for a set of claims
+    '''
+    def __init__(self):
+        self.total_claims = 0
+        self.amount_total = 0.0
+
+        # {months: claims count} for the range from today to the month
+        self.range_counts = dict((m, 0) for m in RANGE_MONTHS)
+
+        # {months: (total, range amount, month amount)}, the month amount
+        # is the amount of the calendar month the given months ago
+        self.amount_range = dict((m, 0.0) for m in AMOUNT_MONTHS)
+        self.amount_month = dict((m, 0.0) for m in AMOUNT_MONTHS)
+
+        self.open_claims = 0
+        self.closed_claims = 0
+
+        # distinct members counts by patient type, in total and by range
+        self.in_patients = dict((m, 0) for m in ['total'] + RANGE_MONTHS)
+        self.out_patients = dict((m, 0) for m in ['total'] + RANGE_MONTHS)
+
+        # {amount or icd code: {window name: claims count}}
+        self.by_cost = {}
+        self.by_icd = {}
+
+    @property
+    def in_patients_perc(self):
+        return percent_of(self.in_patients['total'], self.patients_total())
+
+    @property
+    def out_patients_perc(self):
+        return percent_of(self.out_patients['total'], self.patients_total())
+
+    @property
+    def open_claims_perc(self):
+        return percent_of(self.open_claims, self.total_claims)
+
+    @property
+    def closed_claims_perc(self):
+        return percent_of(self.closed_claims, self.total_claims)
+
+    def patients_total(self):
+        return self.in_patients['total'] + self.out_patients['total']
+
+    def patients_count(self, patients):
+        '''
+        returns the dictionary of the patients counts
+        in the format used by the dashboard template
+        '''
+        return {
+            'total': patients['total'],
+            '1_month': patients[1],
+            '3_months': patients[3],
+            '6_months': patients[6],
+            '24_months': patients[24]
+        }
+
+    def amount_summary(self):
+        '''
+        returns the amounts: (total, range amount, month amount)
+        '''
+        summary = {'total': self.amount_total}
+
+        for months in AMOUNT_MONTHS:
+            summary[str(months)] = (self.amount_total,
+                                    self.amount_range[months],
+                                    self.amount_month[months])
+
+        return summary
+
+    def amount_chart_data(self, now=None):
+        '''
+        returns the amounts of the last 6 calendar months for the chart
+        '''
+        now = now or datetime.now()
+        chart_data = {
+            'labels': [],
+            'values': []
+        }
+
+        for months in reversed(range(6)):
+            chart_data['labels'].append(
+                month_abbr[monthdelta(now, months * -1).month])
+            chart_data['values'].append(self.amount_month[months])
+
+        return chart_data
+
+    def context(self):
+        '''
+        returns the template context of the 1TAP dashboard
+        '''
+        return {
+            'total_claims': self.total_claims,
+            'claims_count': dict((str(m), self.range_counts[m]) \
+                                 for m in RANGE_MONTHS),
+            'amount_summary': self.amount_summary(),
+            'in_patients': self.patients_count(self.in_patients),
+            'out_patients': self.patients_count(self.out_patients),
+            'in_patients_perc': self.in_patients_perc,
+            'out_patients_perc': self.out_patients_perc,
+            'open_claims_count': self.open_claims,
+            'open_claims_perc': self.open_claims_perc,
+            'closed_claims_count': self.closed_claims,
+            'closed_claims_perc': self.closed_claims_perc,
+            'by_cost': self.by_cost,
+            'by_icd': self.by_icd,
+            'in_patients_data': [self.in_patients[m] for m in [5, 3, 0]],
+            'out_patients_data': [self.out_patients[m] for m in [5, 3, 0]],
+            'amount_chart_data': self.amount_chart_data()
+        }
+
+
+def claims_rows(claims_query):
+    '''
+    returns the query of the claims' columns needed by the dashboard,
+    the member's patient type is joined, so no member is loaded
+    '''
+    return claims_query.with_entities(models.Claim.datetime,
+                                      models.Claim.amount_value,
+                                      models.Claim.icd_code,
+                                      models.Claim.status,
+                                      models.Claim.member_id,
+                                      models.Member.patient_type)\
+        .outerjoin(models.Member, models.Claim.member_id == models.Member.id)\
+        .order_by(None)
+
+
+def histogram_key(value):
+    '''
+    returns the row name of the cost or ICD code histogram
+    '''
+    if value is None:
+        return ''
+
+    return value
+
+
+def window_bounds(now):
+    '''
+    returns the half-open bounds of the range windows and
+    of the calendar months, as defined by the Claim model
+    '''
+    claim = models.Claim
+    today = now.date()
+
+    ranges = dict((m, claim.range_bounds(m, today)) \
+                  for m in set(RANGE_MONTHS + AMOUNT_MONTHS))
+    months = dict((m, claim.month_bounds(m, today)) for m in AMOUNT_MONTHS)
+
+    return (ranges, months)
+
+
+def cost_histogram(claims_query, now=None):
+    '''
+    counts the claims by amount in the histogram windows
+    with a single query grouped by the numeric amount
+    '''
+    claim = models.Claim
+    now = now or datetime.now()
+    ranges, months = window_bounds(now)
+    windows = sorted(HISTOGRAM_MONTHS.items())
+
+    counts = [func.sum(case([(claim.in_bounds(ranges[m]), 1)], else_=0)) \
+              for m, name in windows]
+
+    # only the rows of the widest window are scanned
+    rows = claims_query.with_entities(claim.amount_value, *counts)\
+        .filter(claim.amount_value != None)\
+        .filter(claim.in_bounds(ranges[max(HISTOGRAM_MONTHS)]))\
+        .group_by(claim.amount_value)\
+        .order_by(None)
+
+    histogram = {}
+
+    for row in rows:
+        histogram[str(row[0])] = dict(
+            (name, int(count)) for (m, name), count in zip(windows, row[1:]) \
+            if count)
+
+    return histogram
+
+
+def claims_arrays(claims_query):
+    '''
+    loads the claims' columns into NumPy arrays with a single query
+    '''
+    rows = claims_rows(claims_query).all()
+
+    datetimes, amounts, icd_codes, statuses, member_ids, patient_types = \
+        zip(*rows) if rows else ([], [], [], [], [], [])
+
+    return {
+        # the claims without a date are NaT, which fails all comparisons
+        'datetime': np.array(datetimes, dtype='datetime64[s]'),
+        'has_datetime': np.array([d is not None for d in datetimes],
+                                 dtype=bool),
+        'amount': np.array([to_float_or_zero(a) for a in amounts],
+                           dtype=float),
+        'icd_key': np.array([histogram_key(i) for i in icd_codes],
+                            dtype=object),
+        'status': np.array(statuses, dtype=object),
+        'member_id': np.array([m if m is not None else -1 \
+                               for m in member_ids], dtype=np.int64),
+        'patient_type': np.array(patient_types, dtype=object)
+    }
+
+
+def distinct_count(values, mask):
+    return int(np.unique(values[mask]).size)
+
+
+def histogram(summary_histogram, keys, mask, window):
+    '''
+    counts the keys selected by the mask into the histogram's window
+    '''
+    if not mask.any():
+        return
+
+    names, counts = np.unique(keys[mask], return_counts=True)
+
+    for name, count in zip(names.tolist(), counts.tolist()):
+        summary_histogram.setdefault(name, {})[window] = count
+
+
+def summarize_claims(claims_query, now=None):
+    '''
+    computes all the 1TAP dashboard figures of the claims with
+    vectorized operations over the columns, the cost histogram
+    is grouped in the database
+    '''
+    now = now or datetime.now()
+    summary = ClaimsSummary()
+
+    ranges, months = window_bounds(now)
+    claims = claims_arrays(claims_query)
+
+    amount = claims['amount']
+    member_id = claims['member_id']
+
+    summary.total_claims = int(amount.size)
+    summary.amount_total = float(amount.sum())
+    summary.open_claims = int((claims['status'] == 'Open').sum())
+    summary.closed_claims = int((claims['status'] == 'Closed').sum())
+
+    is_in = claims['patient_type'] == 'in'
+    is_out = claims['patient_type'] == 'out'
+
+    summary.in_patients['total'] = distinct_count(member_id, is_in)
+    summary.out_patients['total'] = distinct_count(member_id, is_out)
+
+    def in_bounds(bounds):
+        start, end = bounds
+        return claims['has_datetime'] & \
+            (claims['datetime'] >= np.datetime64(start, 's')) & \
+            (claims['datetime'] < np.datetime64(end, 's'))
+
+    in_range = dict((m, in_bounds(bounds)) for m, bounds in ranges.items())
+
+    for m in RANGE_MONTHS:
+        summary.range_counts[m] = int(in_range[m].sum())
+        summary.in_patients[m] = distinct_count(member_id, in_range[m] & is_in)
+        summary.out_patients[m] = distinct_count(member_id,
+                                                 in_range[m] & is_out)
+
+    for m in AMOUNT_MONTHS:
+        summary.amount_range[m] = float(amount[in_range[m]].sum())
+        summary.amount_month[m] = float(amount[in_bounds(months[m])].sum())
+
+    for m, window in HISTOGRAM_MONTHS.items():
+        histogram(summary.by_icd, claims['icd_key'], in_range[m], window)
+
+    summary.by_cost = cost_histogram(claims_query, now=now)
+
+    return summary
@@ -45,16 +45,3 @@ def safe_div(dividend, divisor):
 
 def percent_of(part, total):
     return safe_div(float(part), float(total)) * 100
-
-
-def patients_amount(claims, _type):
-    """Returns the in-patients for the given claims."""
-    result = []
-
-    for claim in claims:
-        if claim.member.patient_type == _type:
-            result.append(claim.member.id)
-
-    result = list(set(result))
-
-    return result
\ No newline at end of file
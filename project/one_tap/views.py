@@ -1,26 +1,27 @@
 import os
 
-from calendar import month_abbr
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
 
-from flask import flash, render_template, redirect, request, url_for
+from flask import current_app, flash, render_template, redirect, request
+from flask import url_for
 from flask import jsonify, send_from_directory, session
 from flask_login import current_user, login_user
 from sqlalchemy import desc
 
+from .analytics import summarize_claims
 from .forms import ClaimForm, MemberForm, TerminalForm
-from .helpers import pass_generator, percent_of
-from .helpers import patients_amount
+from .helpers import pass_generator
 from . import one_tap
 from .. import config, db, models
 from ..main.forms import GOPForm
 from ..main.helpers import is_admin, is_payer, is_provider, photo_file_name_santizer
 from ..main.services import MedicalDetailsService, MemberService, ClaimService
 from ..main.services import GuaranteeOfPaymentService, TerminalService
+from ..main.services import gop_form_choices_cache, icd_code_index
 from ..models import Claim, Member, Terminal, ICDCode, Provider, Payer
 from ..models import Doctor, User, GuaranteeOfPayment
-from ..models import monthdelta, login_required
+from ..models import login_required
 
 
 medical_details_service = MedicalDetailsService()
@@ -37,129 +38,29 @@ def index():
         providers = []
 
     if is_payer(current_user):
-        claim_ids = [gop.claim.id for gop in current_user.payer.guarantees_of_payment if gop.claim]
-        providers = Provider.query.join(Claim, Provider.claims)\
-            .filter(Claim.id.in_(claim_ids)).all()
+        providers = claim_service.providers_for_payer(current_user.payer).all()
 
     if is_admin(current_user):
         providers = Provider.query.all()
 
-    members = member_service.all_for_user(current_user).all()
+    members_count = member_service.all_for_user(current_user).count()
 
     claims_query = claim_service.all_for_user(current_user)\
                                 .order_by(desc(Claim.datetime))
-    claims = claims_query.all()
-    total_claims = len(claims)
-
-    # get the claims in the given month ranges
-    months = ['0', '1', '3', '5', '6', '24']
-    historical = {}
-    for month in months:
-        historical[month] = Claim.for_months(int(month))
-
-    amount_summary = {'total': Claim.amount_sum(0)[0]}
-    months = ['0', '1', '2', '3', '4', '5', '6', '24']
-    for month in months:
-        amount_summary[month] = Claim.amount_sum(int(month))
-
-    in_patients = {
-        'total': len(patients_amount(claims, 'in')),
-        '1_month': len(patients_amount(historical['1'][0], 'in')),
-        '3_months': len(patients_amount(historical['3'][0], 'in')),
-        '6_months': len(patients_amount(historical['6'][0], 'in')),
-        '24_months': len(patients_amount(historical['24'][0], 'in'))
-    }
-
-    out_patients = {
-        'total': len(patients_amount(claims, 'out')),
-        '1_month': len(patients_amount(historical['1'][0], 'out')),
-        '3_months': len(patients_amount(historical['3'][0], 'out')),
-        '6_months': len(patients_amount(historical['6'][0], 'out')),
-        '24_months': len(patients_amount(historical['24'][0], 'out'))
-    }
-
-    by_cost = {}
-    by_icd = {}
-
-    # calculate values for the Historical Claims section table
-    for key, value in historical.items():
-        for claim in value[0]:
-            # calculate values for the Medical Summary By Cost table
-            if not claim.amount in by_cost:
-                by_cost[claim.amount] = {}
-
-            if not key in by_cost[claim.amount]:
-                by_cost[claim.amount][key] = 1
-            else:
-                by_cost[claim.amount][key] += 1
-
-            # calculate values for the Medical Summary By ICD Code table
-            if not claim.icd_code in by_icd:
-                by_icd[claim.icd_code] = {}
-
-            if not key in by_icd[claim.icd_code]:
-                by_icd[claim.icd_code][key] = 1
-            else:
-                by_icd[claim.icd_code][key] += 1
-
-    in_patients_perc = percent_of(in_patients['total'],
-                            out_patients['total'] + in_patients['total'])
-
-    out_patients_perc = percent_of(out_patients['total'],
-                            out_patients['total'] + in_patients['total'])
-
-    open_claims = claims_query.filter_by(status="Open").all()
-    open_claims_perc = percent_of(len(open_claims), len(claims))
 
-    closed_claims =  claims_query.filter_by(status="Closed").all()
-    closed_claims_perc = percent_of(len(closed_claims), len(claims))
-
-    amount_chart_data = {
-        'labels': [],
-        'values': []
-    }
-    # fill in the chart data for the 5 months
-    for months in reversed(range(6)):
-        month_name = month_abbr[monthdelta(datetime.now(), months * -1).month]
-        amount_chart_data['labels'].append(month_name)
-        amount_chart_data['values'].append(amount_summary[str(months)][2])
-
-    in_patients_data = [
-        len(patients_amount(historical['5'][0], 'in')),
-        len(patients_amount(historical['3'][0], 'in')),
-        len(patients_amount(historical['0'][0], 'in'))
-    ]
-    out_patients_data = [
-        len(patients_amount(historical['5'][0], 'out')),
-        len(patients_amount(historical['3'][0], 'out')),
-        len(patients_amount(historical['0'][0], 'out'))
-    ]
+    # all the dashboard figures are computed in one pass over the claims
+    summary = summarize_claims(claims_query)
 
     pagination, claims = claim_service.prepare_pagination(claims_query)
 
-    context = {
+    context = summary.context()
+    context.update({
         'providers': providers,
-        'members': members,
+        'members_count': members_count,
         'claims': claims,
         'pagination': pagination,
-        'historical': historical,
-        'out_patients': out_patients,
-        'in_patients': in_patients,
-        'amount_summary': amount_summary,
-        'total_claims': total_claims,
-        'by_cost': by_cost,
-        'by_icd': by_icd,
-        'in_patients_perc': in_patients_perc,
-        'out_patients_perc': out_patients_perc,
-        'open_claims':open_claims,
-        'open_claims_perc':open_claims_perc,
-        'closed_claims':closed_claims,
-        'closed_claims_perc':closed_claims_perc,
-        'in_patients_data': in_patients_data,
-        'out_patients_data': out_patients_data,
-        'today': datetime.now(),
-        'amount_chart_data': amount_chart_data
-    }
+        'today': datetime.now()
+    })
 
     return render_template('one_tap/index.html', **context)
 
@@ -262,14 +163,7 @@ def claim(claim_id):
 
     form = GOPForm()
 
-    form.payer.choices += [(p.id, p.company) for p in \
-                           current_user.provider.payers]
-
-    form.icd_codes.choices = [(i.id, i.code) for i in \
-        ICDCode.query.filter(ICDCode.code != 'None' and ICDCode.code != '')]
-
-    form.doctor_name.choices += [(d.id, d.name + ' (%s)' % d.doctor_type) \
-                                for d in current_user.provider.doctors]
+    gop_form_choices_cache.fill_form(form, current_user.provider)
 
     if is_provider(current_user) and request.method != 'POST':
         form.name.data = claim.member.name
@@ -482,45 +376,17 @@ def search():
     if not query or not current_user.is_authenticated:
         return jsonify(found)
 
-    query = query.lower()
-
-    claims = Claim.query.all()
-
-    for claim in claims:
-        # initialazing location variable to put the claim's terminal data here,
-        # if no terminal in a claim's object, it remains None
-        location = None
-
-        if claim.terminal:
-            location = claim.terminal.location
-
-        if query in str(claim.status).lower() \
-        or query in str(claim.claim_number).lower() \
-        or query in str(claim.claim_type).lower() \
-        or query in str(claim.datetime) \
-        or query in str(claim.admitted) \
-        or query in str(claim.discharged) \
-        or query in str(location).lower() \
-        or query in str(claim.amount) :
-            found['results'].append(claim.id)
-            continue
+    found['results'] = claim_service.search(query, current_user)
 
     return jsonify(found)
 
 
 @one_tap.route('/icd-code/search', methods=['GET'])
 def icd_code_search():
-    query = request.args.get('query').lower()
-
-    icd_codes = ICDCode.query.all()
-
-    result = []
-    fields = ['code', 'description', 'common_term']
-    find = lambda query, obj, attr: query in getattr(obj, attr).lower()
+    query = (request.args.get('query') or '').lower()
 
-    for icd_code in icd_codes:
-        if any([find(query, icd_code, field) for field in fields]):
-            result.append(icd_code)
+    result = icd_code_index.search(
+        query, limit=current_app.config['ICD_CODES_SEARCH_LIMIT'])
 
     return render_template('one_tap/icd-code-search-results.html', icd_codes=result,
-                               query=query)
\ No newline at end of file
+                               query=query)
@@ -38,24 +38,67 @@ $.notifyDefaults({
   timer: 5000
 });
 
+// marks the shown notifications as read, a digest stands
+// for all the notifications of its room
+function markNotificationsRead(data) {
+    if (data.room_name) {
+      socket.emit('read-notifications', {room_name: data.room_name});
+    } else if (data.id) {
+      socket.emit('read-notifications', {ids: [data.id]});
+    }
+}
+
+// the time of the newest notification this page has got,
+// it gets only the ones sent after it when it reconnects
+var lastNotificationTime;
+
+function showNotification(data) {
+    if (data.timestamp && !(data.timestamp <= lastNotificationTime)) {
+      lastNotificationTime = data.timestamp;
+    }
+    markNotificationsRead(data);
+    if (typeof preventNtfForRoom != 'undefined' && data.room_name == preventNtfForRoom) {
+      // do nothing
+    } else {
+      // a digest of the notifications sent during a few seconds
+      var title = data.count > 1 ? data.title + ' (' + data.count + ')' : data.title;
+      $.notify({
+        title: title,
+        message: data.message,
+        url: data.url,
+        target: '_blank'
+      });
+      console.log(data);
+      notifyMe(title, data.message, data.url);
+      playSound('/static/sounds/arpeggio');
+    }
+}
+
 var socket = io.connect('http://' + document.domain + ':' + location.port);
 socket.on('connect', function() {
     socket.emit('hello', {data: 'I\'m connected!'});
-    socket.on('message', function(data) {
-        if (typeof preventNtfForRoom != 'undefined' && data.room_name == preventNtfForRoom) {
-          // do nothing
-        } else {
-          $.notify({
-            title: data.title,
-            message: data.message,
-            url: data.url,
-            target: '_blank'
-          });
-          console.log(data);
-          notifyMe(data.title, data.message, data.url);
-          playSound('/static/sounds/arpeggio');
-        }
-    });
+    // the notifications of the open chat room are read
+    if (typeof preventNtfForRoom != 'undefined') {
+      socket.emit('read-notifications', {room_name: preventNtfForRoom});
+    }
+    // get the notifications missed while disconnected
+    socket.emit('pending-notifications', {since: lastNotificationTime});
+});
+socket.on('message', showNotification);
+socket.on('pending-notifications', function(data) {
+    var notifications = data.notifications;
+    if (notifications.length > 3) {
+      // the newest one with the number of the missed ones
+      var digest = $.extend({}, notifications[0], {count: notifications.length});
+      showNotification(digest);
+      socket.emit('read-notifications', {ids: $.map(notifications, function(n) {
+        return n.id;
+      })});
+    } else {
+      for (var i = notifications.length - 1; i >= 0; i--) {
+        showNotification(notifications[i]);
+      }
+    }
 });
 
 // Handling loss of internet connection